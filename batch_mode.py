@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from llm import api_price, build_request_body, client_for
+from logger import logger, capture_records, replay_records
+from main import RuleEngine, VARIANTS
+from ocr_detect import ocr_detect
+from store import ResultStore
+from utils import load_reports, dataset_base, collect_stage_outcomes
+
+# Batch endpoints bill at a discount of the real-time price
+BATCH_PRICE_FACTOR = 0.5
+
+
+class PendingRequest(Exception):
+    """Raised while replaying a report when it reaches a stage whose answer is not known yet"""
+
+    def __init__(self, body: Dict[str, Any]):
+        super().__init__("stage answer pending")
+        self.body = body
+
+
+class ReplayQuery:
+    """Stands in for `llm.query`: answers from the recorded responses, in call order, then asks for the next one"""
+
+    def __init__(self, answers: List[Dict[str, Any]]):
+        self.answers = answers
+        self.position = 0
+
+    def __call__(self, user_msg_txt: str, user_msg_img: Optional[str] = None, system_msg: Optional[str] = None,
+                 model: str = "gpt-4o-mini", temperature: float = 0.0, max_tokens: Optional[int] = None
+                 ) -> Tuple[Dict[str, Any], int, int, float, float]:
+        if self.position < len(self.answers):
+            answer = self.answers[self.position]
+            self.position += 1
+            in_use, out_use = answer["input_usage"], answer["output_usage"]
+            return (answer["response"], in_use, out_use,
+                    in_use * api_price[model]["input"] * BATCH_PRICE_FACTOR,
+                    out_use * api_price[model]["output"] * BATCH_PRICE_FACTOR)
+        raise PendingRequest(build_request_body(user_msg_txt, user_msg_img, system_msg, model, temperature, max_tokens))
+
+
+class ReplayOCR:
+    """Stands in for `ocr_detect`: OCR runs once per report and its result is kept in the batch state"""
+
+    def __init__(self, results: List[List[str]]):
+        self.results = results
+        self.position = 0
+
+    def __call__(self, img_path: str) -> List[str]:
+        if self.position >= len(self.results):
+            self.results.append(ocr_detect(img_path))
+        result = self.results[self.position]
+        self.position += 1
+        return result
+
+
+class BatchPipeline:
+    """
+    Two-phase batch execution of a RuleEngine variant over many reports.
+    `export` replays every unfinished report through the decision tree and writes the request of the stage
+    it is waiting for into a provider-style batch JSONL file; `ingest` records the answers of a results file.
+    Repeating both until `export` writes no request gives every report its verdict.
+    The state (recorded answers, OCR results, verdicts) is kept in a JSON file between phases.
+    """
+
+    def __init__(self, engine: RuleEngine, state_file: str, variant: str = "run",
+                 store: Optional[ResultStore] = None, run_id: Optional[str] = None, max_attempts: int = 3):
+        self.engine = engine
+        self.max_attempts = max_attempts
+        self.state_file = state_file
+        self.variant = variant
+        self.store = store
+        self.run_id = run_id
+        if os.path.exists(state_file):
+            with open(state_file, mode="r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        else:
+            self.state = {"variant": variant, "round": 0, "reports": {}}
+        if self.state["variant"] != variant:
+            raise ValueError(f"{state_file} belongs to variant {self.state['variant']}, not {variant}")
+
+    def save(self):
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, mode="w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_file, self.state_file)
+
+    def add_reports(self, reports: List[dict]):
+        for report in reports:
+            self.state["reports"].setdefault(str(report["index"]), {
+                "description": report["description"],
+                "img": str(dataset_base / "images" / f"{report['index']}.jpg"),
+                "answers": [], "ocr": [], "pending": None, "verdict": None, "status": "pending", "attempts": 0,
+            })
+
+    def _advance(self, idx: str, report: dict) -> Optional[Dict[str, Any]]:
+        """Replay a report; returns the request body it waits for, or None once it has a verdict"""
+        self.engine.query = ReplayQuery(report["answers"])
+        self.engine.ocr = ReplayOCR(report["ocr"])
+        with capture_records() as records, collect_stage_outcomes() as stages:
+            try:
+                consistent = getattr(self.engine, self.variant)(int(idx), report["description"], report["img"])
+            except PendingRequest as pending:
+                return pending.body
+        report["verdict"] = consistent
+        report["status"] = "done"
+        # only the final replay is logged, as one contiguous block like an interactive run
+        replay_records(records)
+        if self.store is not None:
+            self.store.save(self.run_id, int(idx), consistent, stages)
+        return None
+
+    def _replay(self, idx: str, report: dict) -> Optional[Dict[str, Any]]:
+        """
+        `_advance`, tried again right away if the replay itself fails (e.g. OCR of the screenshot); after
+        `max_attempts` failed replays the report is marked failed and left out of later exports
+        """
+        while True:
+            try:
+                return self._advance(idx, report)
+            except Exception as e:
+                report["attempts"] = report.get("attempts", 0) + 1
+                if report["attempts"] >= self.max_attempts:
+                    report["status"], report["error"] = "failed", f"{type(e).__name__}: {e}"
+                    logger.warning(f"Analysis for Report #{idx} failed -- {e}")
+                    return None
+                logger.debug(f"Analysis for Report #{idx} failed ({e}), trying again")
+
+    def export(self, requests_file: str) -> int:
+        """Write the next stage request of every unfinished report; returns the number of requests"""
+        self.state["round"] += 1
+        count = 0
+        with open(requests_file, mode="w", encoding="utf-8") as f:
+            for idx, report in self.state["reports"].items():
+                if report["verdict"] is not None or report.get("status") == "failed":
+                    continue
+                body = self._replay(idx, report)
+                if body is None:
+                    continue
+                custom_id = f"{idx}-{len(report['answers'])}"
+                report["pending"] = custom_id
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                                    "body": body}, ensure_ascii=False) + "\n")
+                count += 1
+        self.save()
+        logger.info(f"Batch round {self.state['round']}: {count} requests written to {requests_file}")
+        return count
+
+    def ingest(self, results_file: str) -> int:
+        """Record the answers of a batch results file; failed requests are requested again by the next export"""
+        ingested = 0
+        with open(results_file, mode="r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                idx = result["custom_id"].rsplit("-", 1)[0]
+                report = self.state["reports"].get(idx)
+                if report is None or report["pending"] != result["custom_id"]:
+                    continue
+                report["pending"] = None
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    logger.warning(f"Batch request {result['custom_id']} failed -- {result.get('error')}")
+                    continue
+                body = response["body"]
+                try:
+                    answer = json.loads(body["choices"][0]["message"]["content"])
+                except (KeyError, IndexError, json.JSONDecodeError) as e:
+                    logger.warning(f"Batch request {result['custom_id']} returned a malformed answer -- {e}")
+                    continue
+                report["answers"].append({"response": answer,
+                                          "input_usage": body["usage"]["prompt_tokens"],
+                                          "output_usage": body["usage"]["completion_tokens"]})
+                ingested += 1
+        self.save()
+        logger.info(f"Batch round {self.state['round']}: {ingested} answers ingested from {results_file}")
+        return ingested
+
+    def unfinished(self) -> Dict[str, int]:
+        """Reports without verdict: still waiting for answers ("pending") or given up on ("failed")"""
+        counts = {"pending": 0, "failed": 0}
+        for report in self.state["reports"].values():
+            if report["verdict"] is None:
+                counts["failed" if report.get("status") == "failed" else "pending"] += 1
+        return counts
+
+
+class LocalBatchEndpoint:
+    """
+    File-based stand-in for a provider batch endpoint: turns a requests file into a results file by
+    answering each request with `responder(body) -> chat completion dict` (the real-time API by default).
+    """
+
+    def __init__(self, responder: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None):
+        self.responder = responder or (lambda body: client_for(body["model"]).complete(**body).model_dump())
+
+    def run(self, requests_file: str, results_file: str):
+        with open(requests_file, mode="r", encoding="utf-8") as fin, \
+                open(results_file, mode="w", encoding="utf-8") as fout:
+            for line in fin:
+                request = json.loads(line)
+                try:
+                    result = {"custom_id": request["custom_id"], "error": None,
+                              "response": {"status_code": 200, "body": self.responder(request["body"])}}
+                except Exception as e:
+                    result = {"custom_id": request["custom_id"], "error": {"message": str(e)}, "response": None}
+                fout.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def run_locally(pipeline: BatchPipeline, endpoint: LocalBatchEndpoint, workdir: str, max_rounds: int = 20):
+    """Alternate export / endpoint / ingest until every report has a verdict (or no progress is possible)"""
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    for _ in range(max_rounds):
+        requests_file = str(Path(workdir) / f"requests_{pipeline.state['round'] + 1}.jsonl")
+        if pipeline.export(requests_file) == 0:
+            break
+        results_file = requests_file.replace("requests_", "results_")
+        endpoint.run(requests_file, results_file)
+        pipeline.ingest(results_file)
+    unfinished = pipeline.unfinished()
+    logger.info(f"Batch run finished: {unfinished['pending']} reports still pending, {unfinished['failed']} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline batch execution of the consistency detection pipeline")
+    parser.add_argument("command", choices=["export", "ingest", "local"])
+    parser.add_argument("--state", default="batch_state.json", help="batch state carried between phases")
+    parser.add_argument("--variant", default="run", choices=[v for v in VARIANTS if v != "run_speculative"])
+    parser.add_argument("--requests", default="batch_requests.jsonl", help="requests file written by export")
+    parser.add_argument("--results", default="batch_results.jsonl", help="results file read by ingest")
+    parser.add_argument("--workdir", default="batch", help="request/result files of the local endpoint")
+    parser.add_argument("--verdict-only", action="store_true", help="skip the reason of boolean stages")
+    parser.add_argument("--run-id", default=None, help="also record finished reports in the result store")
+    parser.add_argument("--store", default="results.sqlite", help="SQLite file of per-report results")
+    parser.add_argument("--max-attempts", type=int, default=3, help="failed replays of a report before it is failed")
+    args = parser.parse_args()
+
+    store = ResultStore(args.store) if args.run_id else None
+    pipeline = BatchPipeline(RuleEngine(verdict_only=args.verdict_only), args.state, args.variant,
+                             store, args.run_id, args.max_attempts)
+    if not pipeline.state["reports"]:
+        pipeline.add_reports(load_reports())
+    if args.command == "export":
+        pipeline.export(args.requests)
+    elif args.command == "ingest":
+        pipeline.ingest(args.results)
+    else:
+        run_locally(pipeline, LocalBatchEndpoint(), args.workdir)
+    if store is not None:
+        store.close()
@@ -0,0 +1,66 @@
+import argparse
+import os
+import time
+from collections import Counter
+from typing import Dict, List
+
+import numpy as np
+
+from image_ingest import image_ingest
+from ocr_detect import OCRDetector, DEFAULT_OCR_MODEL, TIERED_OCR_MODEL
+from utils import dataset_base
+
+
+def tokens(texts: List[str]) -> Counter:
+    """Words of an OCR result, split the way `ocr_detect` splits them"""
+    return Counter(word for text in texts for word in text.split())
+
+
+def benchmark(image_paths: List[str], tiers: List[str], reference: str = DEFAULT_OCR_MODEL) -> Dict[str, dict]:
+    """
+    Per-image latency of each OCR tier, and its recall of the words the reference pipeline reads.
+    Every image is decoded once before timing, so only recognition and post-processing are timed.
+    """
+    detector = OCRDetector()
+    # load every pipeline before timing
+    for tier in set(tiers) | {reference}:
+        detector.recognize(image_paths[0], tier)
+    stats = {tier: {"latency": [], "found": 0, "expected": 0} for tier in tiers}
+    escalation = {}
+    for path in image_paths:
+        with image_ingest.hold(path) as image:
+            image.rgb()
+            expected = tokens(detector.postprocess(detector.recognize(path, reference)))
+            for tier in tiers:
+                before = dict(detector.escalation_stats)
+                start = time.perf_counter()
+                texts = detector.postprocess(detector.recognize(path, tier))
+                stats[tier]["latency"].append(time.perf_counter() - start)
+                stats[tier]["found"] += sum((tokens(texts) & expected).values())
+                stats[tier]["expected"] += sum(expected.values())
+                counts = escalation.setdefault(tier, Counter())
+                counts.update({k: detector.escalation_stats[k] - before[k] for k in before})
+    for tier in tiers:
+        latency = np.array(stats[tier]["latency"]) * 1e3
+        stats[tier].update(mean_ms=latency.mean(), p50_ms=np.percentile(latency, 50),
+                           p95_ms=np.percentile(latency, 95),
+                           recall=stats[tier]["found"] / max(stats[tier]["expected"], 1),
+                           escalated=escalation[tier]["escalated"] / max(escalation[tier]["lines"], 1))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and recall of the OCR tiers")
+    parser.add_argument("--images", default=str(dataset_base / "images"), help="folder of the screenshots")
+    parser.add_argument("--limit", type=int, default=50, help="number of images to benchmark")
+    parser.add_argument("--tiers", nargs="+",
+                        default=["ch_ppocr_mobile_v2.0_xx", TIERED_OCR_MODEL, "ch_ppocr_server_v2.0_xx"])
+    parser.add_argument("--reference", default=DEFAULT_OCR_MODEL, help="pipeline whose words count as ground truth")
+    args = parser.parse_args()
+    paths = sorted(entry.path for entry in os.scandir(args.images) if entry.name.endswith(".jpg"))[:args.limit]
+    results = benchmark(paths, args.tiers, args.reference)
+    print(f"{len(paths)} images, recall of the words read by {args.reference}")
+    print(f"{'tier':<50} {'mean':>9} {'p50':>9} {'p95':>9} {'recall':>7} {'escalated':>10}")
+    for tier, r in results.items():
+        print(f"{tier:<50} {r['mean_ms']:>7.1f}ms {r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms "
+              f"{r['recall']:>7.3f} {r['escalated']:>10.1%}")
@@ -0,0 +1,133 @@
+import argparse
+import copy
+import random
+import time
+from typing import Callable, List
+
+from text_merge import text_sentences_recognition, merge_intersected_texts
+from utils import Text
+
+
+def naive_sentences_recognition(texts: List[Text], justify_ratio: float = 0.2, gap_ratio: float = 2) -> List[Text]:
+    """Reference all-pairs implementation the indexed one must match"""
+    changed = True
+    while changed:
+        changed = False
+        temp_set = []
+        for text_a in texts:
+            merged = False
+            for text_b in temp_set:
+                if text_a.is_on_same_line(
+                        text_b, "h",
+                        bias_justify=justify_ratio * min(text_a.height, text_b.height),
+                        bias_gap=gap_ratio * max(text_a.word_width, text_b.word_width)
+                ):
+                    text_b.merge_text(text_a)
+                    merged = True
+                    changed = True
+                    break
+            if not merged:
+                temp_set.append(text_a)
+        texts = temp_set.copy()
+
+    for i, text in enumerate(texts):
+        text.id = i
+    return texts
+
+
+def naive_merge_intersected(texts: List[Text], bias: float = 2) -> List[Text]:
+    """Reference all-pairs implementation the indexed one must match"""
+    changed = True
+    while changed:
+        changed = False
+        temp_set = []
+        for text_a in texts:
+            merged = False
+            for text_b in temp_set:
+                if text_a.is_intersected(text_b, bias=bias):
+                    text_b.merge_text(text_a)
+                    merged = True
+                    changed = True
+                    break
+            if not merged:
+                temp_set.append(text_a)
+        texts = temp_set.copy()
+    return texts
+
+
+def _box(i, left, top, width, height, rng):
+    word = "".join(rng.choice("abcdefghij") for _ in range(rng.randint(1, 8)))
+    return Text(i, word, {'left': left, 'top': top, 'right': left + width, 'bottom': top + height})
+
+
+def screen_layout(n: int, seed: int = 0) -> List[Text]:
+    """Words on text lines of a tall screenshot, with jittered baselines and gaps, shuffled like OCR output"""
+    rng = random.Random(seed)
+    texts, y = [], 0
+    while len(texts) < n:
+        height = rng.randint(18, 40)
+        x = rng.randint(0, 60)
+        for _ in range(rng.randint(1, 12)):
+            if len(texts) >= n or x > 1080:
+                break
+            width = rng.randint(15, 120)
+            texts.append(_box(len(texts), x, y + rng.randint(-2, 2), width, height + rng.randint(-2, 2), rng))
+            x += width + rng.choice([rng.randint(2, 12), rng.randint(40, 200)])
+        y += height + rng.randint(4, 30)
+    rng.shuffle(texts)
+    return texts
+
+
+def overlap_layout(n: int, seed: int = 0) -> List[Text]:
+    """Duplicated detections: clusters of heavily overlapping boxes, plus a few large boxes spanning many"""
+    rng = random.Random(seed)
+    texts = []
+    while len(texts) < n:
+        left, top = rng.randint(0, 1080), rng.randint(0, 40 * n)
+        width, height = rng.randint(20, 300), rng.randint(15, 40)
+        if rng.random() < 0.02:
+            width, height = rng.randint(300, 1000), rng.randint(100, 400)
+        for _ in range(rng.randint(1, 4)):
+            if len(texts) >= n:
+                break
+            texts.append(_box(len(texts), left + rng.randint(-8, 8), top + rng.randint(-5, 5),
+                              width + rng.randint(-8, 8), height, rng))
+    rng.shuffle(texts)
+    return texts
+
+
+def _signature(texts: List[Text]):
+    return [(t.id, t.content, t.location) for t in texts]
+
+
+def _timed(merge: Callable, texts: List[Text]):
+    batch = copy.deepcopy(texts)
+    start = time.perf_counter()
+    merged = merge(batch)
+    return time.perf_counter() - start, _signature(merged)
+
+
+def pipeline(indexed: bool) -> Callable:
+    merge = merge_intersected_texts if indexed else naive_merge_intersected
+    lines = text_sentences_recognition if indexed else naive_sentences_recognition
+    return lambda texts: lines(merge(texts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of OCR text merging: all-pairs vs spatial index")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000, 2000, 5000])
+    parser.add_argument("--seeds", type=int, default=2, help="layouts per size, each checked for identical output")
+    args = parser.parse_args()
+
+    print(f"{'layout':<8} {'boxes':>6} {'all-pairs':>11} {'indexed':>11} {'speedup':>8}")
+    for name, layout in [("screen", screen_layout), ("overlap", overlap_layout)]:
+        for n in args.sizes:
+            naive, indexed = 0.0, 0.0
+            for seed in range(args.seeds):
+                texts = layout(n, seed)
+                naive_time, expected = _timed(pipeline(False), texts)
+                indexed_time, actual = _timed(pipeline(True), texts)
+                assert actual == expected, f"{name} layout of {n} boxes (seed {seed}): merged output differs"
+                naive += naive_time / args.seeds
+                indexed += indexed_time / args.seeds
+            print(f"{name:<8} {n:>6} {naive * 1e3:>9.2f}ms {indexed * 1e3:>9.2f}ms {naive / indexed:>7.1f}x")
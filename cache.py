@@ -0,0 +1,112 @@
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+@functools.lru_cache(maxsize=4096)
+def _sha256_file(path: str, mtime_ns: int, size: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def sha256_file(path: str) -> str:
+    """Content hash of a file, computed once per file version"""
+    stat = os.stat(path)
+    return _sha256_file(path, stat.st_mtime_ns, stat.st_size)
+
+
+def content_key(*parts: Any) -> str:
+    """Stable hash of JSON-serializable parts"""
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    Persistent key-value cache of JSON values in SQLite, shared across runs and processes.
+    Entries older than `max_age` seconds are dropped; beyond `max_bytes`, least recently used entries go first.
+    A read-only cache never writes (neither new entries nor access times).
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None, max_age: Optional[float] = None,
+                 read_only: bool = False, evict_every: int = 100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.read_only = read_only
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        self.puts = 0
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, timeout=30)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+            self.conn.commit()
+            self.evict()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                return None
+            if not self.read_only:
+                self.conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        if self.read_only:
+            return
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                              (key, data, len(data.encode("utf-8")), now, now))
+            self.conn.commit()
+            self.puts += 1
+            evict = self.puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the cache fits in `max_bytes`"""
+        if self.read_only:
+            return
+        with self.lock:
+            if self.max_age is not None:
+                self.conn.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_bytes is not None:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+                if total > self.max_bytes:
+                    excess = total - self.max_bytes
+                    freed = 0
+                    stale = []
+                    for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY accessed_at"):
+                        stale.append((key,))
+                        freed += size
+                        if freed >= excess:
+                            break
+                    self.conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,291 @@
+import argparse
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from logger import logger
+from store import ResultStore
+from utils import dataset_base, get_labels_true, load_reports
+
+# Triage stages the cascade can answer locally, with the prompt they stand in for
+CASCADE_STAGES = {"visible_in_screenshot": "prompt1", "direct_reflect_from_ui_text": "prompt2"}
+
+
+def ngram_ids(text: str, n_max: int = 3, dim: int = 2 ** 18) -> np.ndarray:
+    """Hashed character n-grams (1 <= n <= n_max) of the text"""
+    grams = {text[i:i + n] for n in range(1, n_max + 1) for i in range(len(text) - n + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) % dim for g in grams), dtype=np.int64, count=len(grams))
+
+
+class NGramClassifier:
+    """Logistic regression over hashed character n-grams"""
+
+    def __init__(self, n_max: int = 3, dim: int = 2 ** 18):
+        self.n_max = n_max
+        self.dim = dim
+        self.weights = np.zeros(dim, dtype=np.float64)
+        self.bias = 0.0
+
+    def _features(self, text: str) -> Tuple[np.ndarray, float]:
+        ids = ngram_ids(text, self.n_max, self.dim)
+        return ids, 1.0 / np.sqrt(max(len(ids), 1))
+
+    def fit(self, texts: List[str], labels: List[bool], epochs: int = 20, lr: float = 0.5, l2: float = 1e-5):
+        features = [self._features(t) for t in texts]
+        y = np.asarray(labels, dtype=np.float64)
+        rng = np.random.default_rng(0)
+        for _ in range(epochs):
+            for i in rng.permutation(len(features)):
+                ids, scale = features[i]
+                p = 1.0 / (1.0 + np.exp(-(self.weights[ids].sum() * scale + self.bias)))
+                grad = p - y[i]
+                self.weights[ids] -= lr * (grad * scale + l2 * self.weights[ids])
+                self.bias -= lr * grad
+        return self
+
+    def predict_proba(self, text: str) -> float:
+        ids, scale = self._features(text)
+        return float(1.0 / (1.0 + np.exp(-(self.weights[ids].sum() * scale + self.bias))))
+
+
+class Cascade:
+    """
+    Local classifiers in front of the LLM triage prompts.
+    A stage is answered locally only when the classifier is at least `threshold` confident; otherwise
+    the caller falls back to the LLM.
+    """
+
+    def __init__(self, classifiers: Dict[str, NGramClassifier], threshold: float = 0.95):
+        self.classifiers = classifiers
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.stats = {stage: {"local": 0, "deferred": 0} for stage in classifiers}
+
+    def answer(self, stage: str, report_txt: str) -> Optional[dict]:
+        """A {result, reason} answer if the local classifier is confident enough, else None; not counted in stats"""
+        classifier = self.classifiers.get(stage)
+        if classifier is None:
+            return None
+        p = classifier.predict_proba(report_txt)
+        if max(p, 1 - p) < self.threshold:
+            return None
+        return {"result": p >= 0.5, "reason": f"local classifier (p={p:.3f})"}
+
+    def decide(self, stage: str, report_txt: str) -> Optional[dict]:
+        """`answer`, counting the stage as answered locally or deferred to the LLM"""
+        if stage not in self.classifiers:
+            return None
+        result = self.answer(stage, report_txt)
+        with self.lock:
+            self.stats[stage]["local" if result is not None else "deferred"] += 1
+        return result
+
+    def log_summary(self):
+        for stage, counts in self.stats.items():
+            total = counts["local"] + counts["deferred"]
+            if total:
+                logger.info(f"Cascade {stage}: {counts['local']}/{total} answered locally "
+                            f"({counts['local'] / total:.1%} LLM calls skipped)")
+
+    def save(self, path: str):
+        arrays = {}
+        for stage, classifier in self.classifiers.items():
+            arrays[f"{stage}.weights"] = classifier.weights
+            arrays[f"{stage}.config"] = np.array([classifier.n_max, classifier.dim, classifier.bias])
+        np.savez_compressed(path, **arrays)
+
+    @staticmethod
+    def load(path: str, threshold: float = 0.95) -> "Cascade":
+        arrays = np.load(path)
+        classifiers = {}
+        for stage in CASCADE_STAGES:
+            if f"{stage}.weights" not in arrays:
+                continue
+            n_max, dim, bias = arrays[f"{stage}.config"]
+            classifier = NGramClassifier(int(n_max), int(dim))
+            classifier.weights = arrays[f"{stage}.weights"]
+            classifier.bias = float(bias)
+            classifiers[stage] = classifier
+        return Cascade(classifiers, threshold)
+
+
+def outcomes_from_store(store_path: str, run_id: str) -> Dict[str, Dict[int, bool]]:
+    """Triage outcomes {stage: {report index: result}} recorded by a past run"""
+    outcomes = {stage: {} for stage in CASCADE_STAGES}
+    store = ResultStore(store_path)
+    for idx, result in store.load(run_id).items():
+        for stage, outcome in result["stages"]:
+            if stage in outcomes:
+                outcomes[stage][idx] = bool(outcome)
+    store.close()
+    return outcomes
+
+
+# variants whose first two stage results are prompt 1 and, if visible, prompt 2
+TRIAGE_FIRST_VARIANTS = (None, "run", "run_speculative")
+
+
+def outcomes_from_log(log_file: str) -> Dict[str, Dict[int, bool]]:
+    """
+    Triage outcomes of the `run` pipeline recovered from a log: prompt 1 comes first, prompt 2 second if visible.
+    In ablation logs, the blocks of the other variants ("[<variant>] Report #N ...") only end a report.
+    """
+    outcomes = {stage: {} for stage in CASCADE_STAGES}
+    pattern1 = r'\{(["\'])result(["\']):\s*(True|False)'
+    pattern2 = r"(?:\[([^\]]+)\] )?Report #(\d+) Consistent?"
+    temp = []
+    with open(log_file, mode="r", encoding="utf-8") as f:
+        for line in f:
+            match1 = re.search(pattern1, line)
+            match2 = re.search(pattern2, line)
+            if "WARNING" in line:
+                temp.clear()
+            if match1:
+                temp.append(match1.group(3) == "True")
+            elif match2:
+                idx = int(match2.group(2))
+                if match2.group(1) not in TRIAGE_FIRST_VARIANTS:
+                    temp.clear()
+                    continue
+                if temp:
+                    outcomes["visible_in_screenshot"][idx] = temp[0]
+                if len(temp) > 1 and temp[0]:
+                    outcomes["direct_reflect_from_ui_text"][idx] = temp[1]
+                temp.clear()
+    return outcomes
+
+
+def verdicts_from_store(store_path: str, run_id: str) -> Dict[int, bool]:
+    """Verdicts {report index: consistent} of a past run"""
+    store = ResultStore(store_path)
+    verdicts = {idx: result["verdict"] for idx, result in store.load(run_id).items()}
+    store.close()
+    return verdicts
+
+
+def verdicts_from_log(log_file: str) -> Dict[int, bool]:
+    """Verdicts of the `run` pipeline in a log (of `run` or `run_speculative` in ablation logs)"""
+    verdicts = {}
+    pattern = re.compile(r"(?:\[([^\]]+)\] )?Report #(\d+) Consistent\? (True|False)")
+    with open(log_file, mode="r", encoding="utf-8") as f:
+        for line in f:
+            match = pattern.search(line)
+            if match and match.group(1) in TRIAGE_FIRST_VARIANTS:
+                verdicts[int(match.group(2))] = match.group(3) == "True"
+    return verdicts
+
+
+def split(indices: List[int], holdout: int = 5) -> Tuple[List[int], List[int]]:
+    """Deterministic train/test split: every `holdout`-th report is held out"""
+    return [i for i in indices if i % holdout != 0], [i for i in indices if i % holdout == 0]
+
+
+def train(outcomes: Dict[str, Dict[int, bool]], holdout: int = 5) -> Cascade:
+    texts = {report["index"]: report["description"] for report in load_reports()}
+    classifiers = {}
+    for stage, labels in outcomes.items():
+        train_idx, _ = split(sorted(labels), holdout)
+        if not train_idx:
+            continue
+        classifiers[stage] = NGramClassifier().fit([texts[i] for i in train_idx], [labels[i] for i in train_idx])
+    return Cascade(classifiers)
+
+
+def _diverges(cascade: Cascade, report_txt: str, outcomes: Dict[str, Dict[int, bool]], idx: int) -> bool:
+    """Whether the cascade sends the report down another path of the decision tree than the LLM did"""
+    visible = outcomes["visible_in_screenshot"].get(idx)
+    answer = cascade.answer("visible_in_screenshot", report_txt)
+    if answer is not None and answer["result"] != visible:
+        return True
+    if not visible:
+        # prompt 2 is only asked for visible bugs
+        return False
+    answer = cascade.answer("direct_reflect_from_ui_text", report_txt)
+    return answer is not None and answer["result"] != outcomes["direct_reflect_from_ui_text"].get(idx)
+
+
+def evaluate(cascade: Cascade, outcomes: Dict[str, Dict[int, bool]], verdicts: Dict[int, bool], holdout: int = 5,
+             engine=None):
+    """
+    Print, per stage, how many LLM calls the cascade would skip on held-out reports and how often it agrees
+    with the LLM; then the end-to-end verdict accuracy against the dataset labels with and without cascade.
+    A report the cascade sends down the same path as the LLM keeps the LLM verdict. The others are analyzed
+    again by `engine` (a RuleEngine using the cascade) if given, else the accuracy is given as a range.
+    """
+    reports = {report["index"]: report for report in load_reports()}
+    for stage, labels in outcomes.items():
+        if stage not in cascade.classifiers:
+            continue
+        _, test_idx = split(sorted(labels), holdout)
+        local, agree = 0, 0
+        for idx in test_idx:
+            answer = cascade.answer(stage, reports[idx]["description"])
+            if answer is None:
+                continue
+            local += 1
+            agree += answer["result"] == labels[idx]
+        total = len(test_idx)
+        print(f"{stage}: {local}/{total} calls skipped ({local / max(total, 1):.1%}); "
+              f"agreement with LLM on skipped calls = {agree / max(local, 1):.3f}")
+
+    truth = get_labels_true()
+    _, test_idx = split(sorted(idx for idx in verdicts if str(idx) in truth), holdout)
+    llm_correct, cascade_correct, diverged, unknown = 0, 0, 0, 0
+    for idx in test_idx:
+        report = reports[idx]
+        label = truth[str(idx)]
+        llm_correct += verdicts[idx] == label
+        if not _diverges(cascade, report["description"], outcomes, idx):
+            cascade_correct += verdicts[idx] == label
+            continue
+        diverged += 1
+        if engine is None:
+            unknown += 1
+            continue
+        img = str(dataset_base / "images" / f"{idx}.jpg")
+        try:
+            cascade_correct += engine.run(idx, report["description"], img) == label
+        except Exception as e:
+            logger.warning(f"Analysis for Report #{idx} failed -- {e}")
+            unknown += 1
+    total = max(len(test_idx), 1)
+    llm_accuracy = llm_correct / total
+    low, high = cascade_correct / total, (cascade_correct + unknown) / total
+    print(f"end-to-end on {len(test_idx)} held-out reports: {diverged} take another path with the cascade")
+    print(f"verdict accuracy with LLM only = {llm_accuracy:.3f}")
+    if unknown:
+        print(f"verdict accuracy with cascade = {low:.3f} to {high:.3f} "
+              f"(delta {low - llm_accuracy:+.3f} to {high - llm_accuracy:+.3f}; "
+              f"{unknown} reports not analyzed again, see --rerun)")
+    else:
+        print(f"verdict accuracy with cascade = {low:.3f} (delta {low - llm_accuracy:+.3f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train/evaluate the local triage cascade")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--model", default="cascade.npz", help="classifier file to write (train) or read (evaluate)")
+    parser.add_argument("--store", default="results.sqlite", help="result store holding past stage outcomes")
+    parser.add_argument("--run-id", default=None, help="run whose stage outcomes are used as labels")
+    parser.add_argument("--log", default=None, help="use the outcomes logged in this log file instead of the store")
+    parser.add_argument("--threshold", type=float, default=0.95, help="minimum confidence to answer locally")
+    parser.add_argument("--rerun", action="store_true", help="evaluate: analyze again, with the cascade and the "
+                                                              "LLM, the reports the cascade sends down another path")
+    args = parser.parse_args()
+    if args.log is None and args.run_id is None:
+        parser.error("either --run-id or --log is required")
+    outcomes = outcomes_from_log(args.log) if args.log else outcomes_from_store(args.store, args.run_id)
+    if args.command == "train":
+        train(outcomes).save(args.model)
+        print(f"cascade saved to {args.model}")
+    else:
+        cascade = Cascade.load(args.model, args.threshold)
+        verdicts = verdicts_from_log(args.log) if args.log else verdicts_from_store(args.store, args.run_id)
+        engine = None
+        if args.rerun:
+            from main import RuleEngine
+            engine = RuleEngine(cascade=cascade)
+        evaluate(cascade, outcomes, verdicts, engine=engine)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from logger import logger
+from utils import dataset_base
+
+# One row per report: its index, and where its JSON line lies in the line file
+INDEX_DTYPE = np.dtype([("index", "<i8"), ("offset", "<i8"), ("length", "<i4")])
+
+
+def _iter_json_array(path: Path, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Yield the objects of a JSON array file one by one, never holding more than a chunk of text"""
+    decoder = json.JSONDecoder()
+    with open(path, mode="r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        while True:
+            # skip the separators between objects
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,[":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield obj
+            pos = end
+
+
+def convert(source: Path, lines: Path, index: Path, labels: Path) -> int:
+    """
+    Convert a JSON array of reports into one JSON line per report, plus the offset index and the labels.
+    Every file is written next to its target under a name of its own and moved into place, so concurrent
+    readers see old or new files and workers converting at the same time do not write into each other's files.
+    """
+    tag = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    tmp_lines = lines.with_name(f"{lines.name}.{tag}.tmp")
+    tmp_index, tmp_labels = (path.with_name(f"{path.name}.{tag}.tmp.npy") for path in (index, labels))
+    try:
+        rows, consistent = [], []
+        with open(tmp_lines, "wb") as f:
+            for report in _iter_json_array(source):
+                line = (json.dumps(report, ensure_ascii=False) + "\n").encode("utf-8")
+                rows.append((report["index"], f.tell(), len(line)))
+                consistent.append(bool(report.get("consistent", False)))
+                f.write(line)
+        np.save(tmp_index, np.array(rows, dtype=INDEX_DTYPE))
+        np.save(tmp_labels, np.array(consistent, dtype=np.bool_))
+        os.replace(tmp_index, index)
+        os.replace(tmp_labels, labels)
+        # the line file goes last: it is the newest file only once the index and labels match it
+        os.replace(tmp_lines, lines)
+    finally:
+        for tmp_path in (tmp_lines, tmp_index, tmp_labels):
+            tmp_path.unlink(missing_ok=True)
+    return len(rows)
+
+
+class ReportDataset:
+    """
+    Reports of a dataset file, read lazily from a line-oriented copy through a memory-mapped offset index.
+    The copy (`<name>.jsonl`, `<name>.index.npy`, `<name>.labels.npy`) is built on first use and rebuilt when
+    the source changes. Iterating reads one line per report; `get(index)` seeks straight to a report; and
+    `shard(i, n)` / `exclude(indices)` return views over a subset of the rows without reading any report.
+    """
+
+    def __init__(self, source: Optional[str] = None, rows: Optional[np.ndarray] = None, _table=None):
+        self.source = Path(source) if source else dataset_base / "dataset.txt"
+        self.lines = self.source.with_suffix(".jsonl")
+        if _table is None:
+            _table = self._open()
+        self.table, self.all_labels = _table
+        self.rows = np.arange(len(self.table)) if rows is None else rows
+        self._order: Optional[np.ndarray] = None
+
+    def _open(self):
+        index = self.source.with_suffix(".index.npy")
+        labels = self.source.with_suffix(".labels.npy")
+        derived = (self.lines, index, labels)
+        if not all(p.exists() for p in derived) or \
+                min(p.stat().st_mtime for p in derived) < self.source.stat().st_mtime:
+            count = convert(self.source, self.lines, index, labels)
+            logger.info(f"Converted {count} reports of {self.source} into {self.lines}")
+        return np.load(index, mmap_mode="r"), np.load(labels, mmap_mode="r")
+
+    def _view(self, rows: np.ndarray) -> "ReportDataset":
+        return ReportDataset(str(self.source), rows, (self.table, self.all_labels))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def indices(self) -> np.ndarray:
+        """Report indices of the rows, in dataset order"""
+        return np.asarray(self.table["index"][self.rows])
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Ground-truth consistency of the rows, as a bool array aligned with `indices`"""
+        return np.asarray(self.all_labels[self.rows])
+
+    def _read(self, f, row: int) -> dict:
+        f.seek(int(self.table["offset"][row]))
+        return json.loads(f.read(int(self.table["length"][row])))
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.lines, "rb") as f:
+            for row in self.rows:
+                yield self._read(f, row)
+
+    def chunks(self, size: int) -> Iterator[List[dict]]:
+        """Consecutive lists of at most `size` reports"""
+        for start in range(0, len(self.rows), max(size, 1)):
+            yield list(self._view(self.rows[start:start + size]))
+
+    def _row(self, index: int) -> int:
+        if self._order is None:
+            self._order = np.argsort(self.table["index"], kind="stable")
+        ids = self.table["index"]
+        pos = int(np.searchsorted(ids, index, sorter=self._order))
+        if pos == len(ids) or ids[self._order[pos]] != index:
+            raise KeyError(f"no report with index {index}")
+        return int(self._order[pos])
+
+    def get(self, index: int) -> dict:
+        """The report with this index (looked up in the whole dataset, not only in the view)"""
+        with open(self.lines, "rb") as f:
+            return self._read(f, self._row(index))
+
+    def label(self, index: int) -> bool:
+        return bool(self.all_labels[self._row(index)])
+
+    def shard(self, i: int, n: int) -> "ReportDataset":
+        """Shard `i` of `n`: the reports whose index is `i` modulo `n`, stable as the dataset grows"""
+        if not 0 <= i < n:
+            raise ValueError(f"shard {i} of {n} does not exist")
+        return self._view(self.rows[self.table["index"][self.rows] % n == i])
+
+    def exclude(self, indices: Iterable[int]) -> "ReportDataset":
+        """The reports whose index is not in `indices`"""
+        skip = np.fromiter(indices, dtype=np.int64)
+        return self._view(self.rows[~np.isin(self.table["index"][self.rows], skip)])
+
+    def labels_dict(self) -> Dict[str, bool]:
+        """{str(index): consistent}, the format of `utils.get_labels_true`"""
+        return {str(k): bool(v) for k, v in zip(self.indices.tolist(), self.labels.tolist())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the dataset into its indexed line format")
+    parser.add_argument("--source", default=str(dataset_base / "dataset.txt"), help="JSON array of reports")
+    parser.add_argument("--shard", default=None, metavar="I/N", help="only summarize shard I of N")
+    args = parser.parse_args()
+    dataset = ReportDataset(args.source)
+    if args.shard:
+        i, _, n = args.shard.partition("/")
+        dataset = dataset.shard(int(i), int(n))
+    print(f"{len(dataset)} reports, {int(dataset.labels.sum())} consistent, index file {dataset.lines}")
@@ -0,0 +1,186 @@
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Set
+
+from dataset import ReportDataset
+from logger import logger, set_run_id
+from main import RuleEngine, VARIANTS, analyze_report, variant_run_id
+from store import ResultStore, WorkQueue
+
+
+class Heartbeat:
+    """Renews the leases of the reports a worker is analyzing, from a background thread"""
+
+    def __init__(self, queue: WorkQueue, run_id: str, worker: str, ttl: float):
+        self.queue = queue
+        self.run_id = run_id
+        self.worker = worker
+        self.ttl = ttl
+        self.held: Set[int] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+
+    def add(self, indices: Iterable[int]):
+        with self.lock:
+            self.held.update(indices)
+
+    def discard(self, idx: int):
+        with self.lock:
+            self.held.discard(idx)
+
+    def _beat(self):
+        # renew three times per lease period, so one slow beat does not lose the leases
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                held = set(self.held)
+            try:
+                lost = self.queue.heartbeat(self.run_id, self.worker, held, self.ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"Heartbeat of worker {self.worker} failed -- {e}")
+                continue
+            if lost:
+                logger.warning(f"Worker {self.worker} lost the leases of reports {sorted(lost)}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(queue_path: str, run_id: str, variants: List[str], workers: int = 4, lease_ttl: float = 300.0,
+               max_attempts: int = 3, worker_id: Optional[str] = None, verdict_only: bool = False,
+               audit_rate: float = 0.0) -> Dict[str, int]:
+    """
+    Analyze reports leased from the shared queue until every report of the run is done or failed.
+    A worker only leases as many reports as it has free slots, so any number of workers on any number of
+    hosts share the run evenly; a report whose worker died is picked up again once its lease expires.
+    :param queue_path: SQLite file of the queue, shared by all workers
+    :param workers: reports analyzed concurrently by this worker
+    :param lease_ttl: seconds a lease lasts without heartbeat
+    :param max_attempts: analyses of a report before it is marked failed
+    """
+    set_run_id(run_id)
+    queue = WorkQueue(queue_path)
+    dataset = ReportDataset()
+    added = queue.populate(run_id, dataset.indices.tolist())
+    worker = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+    logger.info(f"Worker {worker} joined run {run_id} ({added} reports queued by this worker)")
+    re = RuleEngine(stage_workers=3 * max(workers, 1), verdict_only=verdict_only, audit_rate=audit_rate)
+    counts = {"done": 0, "failed": 0}
+    start_time = time.perf_counter()
+
+    def work(idx: int) -> bool:
+        results = analyze_report(re, dataset.get(idx), variants)
+        try:
+            if results is None:
+                queue.release(run_id, worker, idx, max_attempts)
+            elif not queue.complete(run_id, worker, idx, {
+                    variant_run_id(run_id, variant, variants): (r["verdict"], r["stages"])
+                    for variant, r in results.items()}):
+                logger.warning(f"Worker {worker} lost the lease of report {idx} before completing it")
+        except sqlite3.Error as e:
+            # the lease expires and the report is analyzed again by whichever worker reclaims it
+            logger.warning(f"Worker {worker} could not record report {idx} -- {e}")
+            results = None
+        finally:
+            heartbeat.discard(idx)
+        return results is not None
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool, \
+            Heartbeat(queue, run_id, worker, lease_ttl) as heartbeat:
+        while True:
+            free = max(workers, 1) - len(in_flight)
+            if free > 0:
+                leased = queue.lease(run_id, worker, free, lease_ttl, max_attempts)
+                heartbeat.add(leased)
+                in_flight.update(pool.submit(work, idx) for idx in leased)
+            if not in_flight:
+                status = queue.status(run_id)
+                if status["pending"] + status["leased"] == 0:
+                    break
+                # the rest is leased by other workers; wait for it to finish or for a lease to expire
+                time.sleep(min(lease_ttl / 4, 5.0))
+                continue
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                counts["done" if future.result() else "failed"] += 1
+    queue.close()
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Worker {worker} finished: {counts['done']} reports done, {counts['failed']} failed "
+                f"in {elapsed:.1f}s ({counts['done'] / max(elapsed, 1e-9):.2f} reports/s)")
+    return counts
+
+
+def merge_results(sources: List[str], run_id: str, target: Optional[str] = None,
+                  log_file: Optional[str] = None) -> Dict[str, Dict[int, dict]]:
+    """
+    Gather the results of a run (and of its variants, `<run_id>/<variant>`) from several stores.
+    They are written to the `target` store and, as "Report #N Consistent? <verdict>" lines that
+    `result_analysis.py` reads, to `log_file`. Later sources win for reports present in several.
+    """
+    merged: Dict[str, Dict[int, dict]] = {}
+    for source in sources:
+        store = ResultStore(source)
+        try:
+            for result_run_id in store.runs():
+                if result_run_id == run_id or result_run_id.startswith(run_id + "/"):
+                    merged.setdefault(result_run_id, {}).update(store.load(result_run_id))
+        finally:
+            store.close()
+    if target:
+        store = ResultStore(target)
+        for result_run_id, results in merged.items():
+            store.save_run(result_run_id, results)
+        store.close()
+    if log_file:
+        with open(log_file, mode="w", encoding="utf-8") as f:
+            for result_run_id in sorted(merged):
+                variant = result_run_id[len(run_id) + 1:]
+                prefix = f"[{variant}] " if variant else ""
+                for idx, result in sorted(merged[result_run_id].items()):
+                    f.write(f"{prefix}Report #{idx} Consistent? {result['verdict']}\n")
+    for result_run_id, results in sorted(merged.items()):
+        logger.info(f"Merged {len(results)} results of {result_run_id}")
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed execution over a lease-based report queue")
+    parser.add_argument("command", choices=["worker", "status", "merge"])
+    parser.add_argument("--queue", default="queue.sqlite", help="SQLite file of the queue, shared by all workers")
+    parser.add_argument("--run-id", required=True, help="id of the run")
+    parser.add_argument("--workers", type=int, default=4, help="reports analyzed concurrently by this worker")
+    parser.add_argument("--variants", default="run", help=f"comma-separated variants, from: {','.join(VARIANTS)}")
+    parser.add_argument("--lease-ttl", type=float, default=300.0, help="seconds a lease lasts without heartbeat")
+    parser.add_argument("--max-attempts", type=int, default=3, help="analyses of a report before it is failed")
+    parser.add_argument("--worker-id", default=None, help="name of this worker (default: host:pid:random)")
+    parser.add_argument("--verdict-only", action="store_true", help="skip the reason of boolean stages")
+    parser.add_argument("--audit-rate", type=float, default=0.0, help="fraction of reports keeping reasons")
+    parser.add_argument("--sources", nargs="+", default=None, help="stores to merge (default: --queue)")
+    parser.add_argument("--store", default=None, help="store receiving the merged results")
+    parser.add_argument("--log", default=None, help="verdict log of the merged results, for result_analysis.py")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        variants = args.variants.split(",")
+        if any(v not in VARIANTS for v in variants):
+            parser.error(f"--variants must be chosen from {','.join(VARIANTS)}")
+        run_worker(args.queue, args.run_id, variants, args.workers, args.lease_ttl, args.max_attempts,
+                   args.worker_id, args.verdict_only, args.audit_rate)
+    elif args.command == "status":
+        queue = WorkQueue(args.queue)
+        print(", ".join(f"{state}: {count}" for state, count in queue.status(args.run_id).items()))
+        queue.close()
+    else:
+        merge_results(args.sources or [args.queue], args.run_id, args.store, args.log)
@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+from cache import sha256_file
+from logger import logger
+
+# Responses worth retrying; any other error status fails the file at once
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, retryable: bool, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class Downloader:
+    """
+    Concurrent file downloader over one pooled HTTP session.
+    Bodies are streamed into a temporary file next to the target and moved into place once complete, so a
+    target file is never partial. Transient failures are retried with jittered exponential backoff.
+    A JSON manifest records url, size, sha256 and status of every file; files whose manifest entry matches
+    what is on disk are skipped, so a rerun only fetches missing, failed or corrupt files. Files already on disk
+    without an entry are adopted into the manifest instead of fetched again.
+    """
+
+    def __init__(self, target_dir: str, manifest_path: Optional[str] = None, workers: int = 8,
+                 max_retries: int = 4, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 timeout: Tuple[float, float] = (10.0, 60.0), chunk_size: int = 1 << 16):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.target_dir = Path(target_dir)
+        self.target_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = Path(manifest_path) if manifest_path else self.target_dir / "manifest.json"
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.manifest: Dict[str, dict] = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, mode="r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def save_manifest(self):
+        with self.lock:
+            data = json.dumps(self.manifest, ensure_ascii=False, indent=1, sort_keys=True)
+        tmp_file = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(tmp_file, mode="w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_file, self.manifest_path)
+
+    def is_complete(self, name: str, url: str) -> bool:
+        """
+        Whether the file was downloaded from this url and is still intact on disk.
+        A file on disk without manifest entry (fetched before there was a manifest) is taken as complete and
+        recorded in the manifest with its current size and hash.
+        """
+        entry = self.manifest.get(name)
+        path = self.target_dir / name
+        if entry is None and path.is_file() and path.stat().st_size > 0:
+            with self.lock:
+                self.manifest[name] = {"url": url, "status": "ok", "size": path.stat().st_size,
+                                       "sha256": sha256_file(str(path)), "attempts": 0}
+            return True
+        if entry is None or entry["status"] != "ok" or entry["url"] != url or not path.exists():
+            return False
+        return path.stat().st_size == entry["size"] and sha256_file(str(path)) == entry["sha256"]
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        # full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def _fetch_once(self, url: str, path: Path) -> Tuple[int, str]:
+        import requests
+        tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.part")
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    retry_after = response.headers.get("Retry-After")
+                    raise DownloadError(f"HTTP {response.status_code}", response.status_code in RETRYABLE_STATUS,
+                                        float(retry_after) if retry_after and retry_after.isdigit() else None)
+                expected = response.headers.get("Content-Length")
+                digest = hashlib.sha256()
+                size = 0
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                if expected is not None and "Content-Encoding" not in response.headers and size != int(expected):
+                    raise DownloadError(f"truncated body ({size} of {expected} bytes)", True)
+            os.replace(tmp_path, path)
+            return size, digest.hexdigest()
+        except requests.RequestException as e:
+            raise DownloadError(f"{type(e).__name__}: {e}", True) from e
+        except OSError as e:
+            # writing the file failed (disk full, permissions): retrying will not help
+            raise DownloadError(f"{type(e).__name__}: {e}", False) from e
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def fetch(self, url: str, name: str) -> dict:
+        """Download one file (with retries) and record the outcome in the manifest"""
+        path = self.target_dir / name
+        attempt = 0
+        while True:
+            try:
+                size, sha256 = self._fetch_once(url, path)
+                entry = {"url": url, "status": "ok", "size": size, "sha256": sha256, "attempts": attempt + 1}
+                break
+            except DownloadError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    entry = {"url": url, "status": "failed", "error": str(e), "attempts": attempt + 1}
+                    logger.warning(f"Download of {url} failed -- {e}")
+                    break
+                delay = self._backoff(attempt, e.retry_after)
+                logger.debug(f"Download of {url} failed ({e}), retrying in {delay:.1f}s")
+                attempt += 1
+                time.sleep(delay)
+        with self.lock:
+            self.manifest[name] = entry
+        return entry
+
+    def download_all(self, items: Iterable[Tuple[str, str]], save_every: int = 50) -> Dict[str, int]:
+        """Download every (url, file name) not yet complete; returns counts per outcome"""
+        counts = {"skipped": 0, "ok": 0, "failed": 0}
+        todo = []
+        for url, name in items:
+            if self.is_complete(name, url):
+                counts["skipped"] += 1
+            else:
+                todo.append((url, name))
+        logger.info(f"Download: {counts['skipped']} files complete, {len(todo)} to fetch")
+        start_time = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                futures = [pool.submit(self.fetch, url, name) for url, name in todo]
+                for done, future in enumerate(as_completed(futures), 1):
+                    counts[future.result()["status"]] += 1
+                    if done % save_every == 0:
+                        self.save_manifest()
+        finally:
+            # the files fetched so far are not fetched again, even if the run was interrupted
+            self.save_manifest()
+        logger.info(f"Download: {counts['ok']} fetched, {counts['failed']} failed "
+                    f"in {time.perf_counter() - start_time:.1f}s")
+        return counts
+
+    def close(self):
+        self.session.close()
+
+
+def download_dataset(reports: Iterable[dict], target_dir: str, workers: int = 8,
+                     manifest_path: Optional[str] = None) -> Dict[str, int]:
+    """Download the screenshot of every report to <target_dir>/<index>.jpg"""
+    downloader = Downloader(target_dir, manifest_path, workers)
+    try:
+        return downloader.download_all((report["img_url"], f"{report['index']}.jpg") for report in reports)
+    finally:
+        downloader.close()
+
+
+if __name__ == "__main__":
+    from utils import dataset_base, load_reports
+    parser = argparse.ArgumentParser(description="Download the dataset screenshots")
+    parser.add_argument("--target", default=str(dataset_base / "images"), help="folder of the screenshots")
+    parser.add_argument("--manifest", default=None, help="manifest file (default: <target>/manifest.json)")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent downloads")
+    args = parser.parse_args()
+    download_dataset(load_reports(), args.target, args.workers, args.manifest)
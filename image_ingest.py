@@ -0,0 +1,117 @@
+import hashlib
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+from cache import sha256_file
+from tracing import span
+
+
+class IngestedImage:
+    """
+    A screenshot read once: the file is memory-mapped on first use, and its content hash and decoded RGB pixels
+    are computed at most once from that mapping. `raw` and `rgb()` are read-only views shared by all users.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = 0
+        self.lock = threading.RLock()
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._digest: Optional[str] = None
+        self._rgb: Optional[np.ndarray] = None
+
+    @property
+    def raw(self) -> memoryview:
+        """Encoded file content"""
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+                if os.fstat(self._file.fileno()).st_size:
+                    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map if self._map is not None else b"")
+
+    @property
+    def digest(self) -> str:
+        """sha256 of the file content, the same key as `cache.sha256_file`"""
+        with self.lock:
+            if self._digest is None:
+                self._digest = hashlib.sha256(self.raw).hexdigest()
+            return self._digest
+
+    def rgb(self) -> np.ndarray:
+        """Decoded H x W x 3 RGB pixels, decoded on first use"""
+        with self.lock:
+            if self._rgb is None:
+                import cv2
+                with span("image.decode"):
+                    pixels = cv2.imdecode(np.frombuffer(self.raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if pixels is None:
+                        raise ValueError(f"cannot decode image {self.path}")
+                    cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB, dst=pixels)
+                pixels.flags.writeable = False
+                self._rgb = pixels
+            return self._rgb
+
+    def close(self):
+        with self.lock:
+            self._rgb = None
+            if self._map is not None:
+                try:
+                    self._map.close()
+                except BufferError:
+                    # a caller still holds a view of the mapping; it is unmapped once that view is gone
+                    pass
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ImageIngest:
+    """
+    Registry of the screenshots in use. `hold(path)` gives the shared `IngestedImage` of a path and keeps it
+    alive until the last holder exits, so a report holding its screenshot for its whole analysis reads
+    and decodes it once for OCR and the vision payload alike, and frees it when the report finishes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images: Dict[str, IngestedImage] = {}
+
+    @contextmanager
+    def hold(self, path: str) -> Iterator[IngestedImage]:
+        with self.lock:
+            image = self.images.get(path)
+            if image is None:
+                image = self.images[path] = IngestedImage(path)
+            image.refs += 1
+        try:
+            yield image
+        finally:
+            with self.lock:
+                image.refs -= 1
+                if image.refs == 0:
+                    del self.images[path]
+                    image.close()
+
+    def digest(self, path: str) -> str:
+        """Content hash of an image, from its buffer if it is held, else from the file"""
+        with self.lock:
+            held = path in self.images
+        if not held:
+            return sha256_file(path)
+        with self.hold(path) as image:
+            return image.digest
+
+    def held(self) -> int:
+        with self.lock:
+            return len(self.images)
+
+
+image_ingest = ImageIngest()
@@ -1,8 +1,19 @@
+import io
 import json
 import base64
-from typing import Dict, Optional, Tuple, Any
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple, Any
 
-from openai import OpenAI
+from PIL import Image
+
+from cache import DiskCache, content_key
+from image_ingest import IngestedImage, image_ingest
+from llm_client import AsyncLLMClient
+from logger import logger
+from tracing import span
 
 api_price = {
     "gpt-4o-mini": {"input": 0.00000015, "output": 0.0000006},
@@ -11,53 +22,256 @@ api_price = {
     "qwen-plus": {"input": 0.000000112, "output": 0.00000112},
 }
 
-gpt_client = OpenAI()
+gpt_client = AsyncLLMClient()
 
-qwen_client = OpenAI()
+qwen_client = AsyncLLMClient()
 
 
-def query(
-        user_msg_txt: str,
-        user_msg_img: Optional[str] = None,
-        system_msg: Optional[str] = None,
-        model: str = "gpt-4o-mini",
-        temperature: float = 0.0,
-) -> Tuple[Dict[str, Any], int, int, float, float]:
+def client_for(model: str) -> AsyncLLMClient:
+    return gpt_client if model.startswith("gpt") else qwen_client
+
+
+def set_rate_limit(model: str, rpm: Optional[float] = None, tpm: Optional[float] = None):
+    """Keep requests to `model` within `rpm` requests and `tpm` tokens per minute"""
+    client_for(model).set_rate_limit(model, rpm, tpm)
+
+# Per-model cap on in-flight requests, shared by all worker threads.
+model_slots: Dict[str, threading.BoundedSemaphore] = {}
+
+
+def set_concurrency_limit(model: str, limit: Optional[int]):
+    """Allow at most `limit` concurrent requests to `model` (None removes the cap)"""
+    if limit is None:
+        model_slots.pop(model, None)
+    else:
+        model_slots[model] = threading.BoundedSemaphore(limit)
+
+
+# Content-addressed cache of deterministic (temperature 0) responses, see `configure_cache`
+response_cache: Optional[DiskCache] = None
+cache_replay = False
+# whether the last `query` of this context was answered from the cache, see `take_cache_hit`
+_cache_hit: ContextVar[bool] = ContextVar("cache_hit", default=False)
+
+
+def take_cache_hit() -> bool:
+    """Whether the last `query` of this context was answered from the response cache (and cost nothing); resets"""
+    hit = _cache_hit.get()
+    _cache_hit.set(False)
+    return hit
+
+
+class CacheMissError(RuntimeError):
+    """Raised in replay mode when a request has no cached response"""
+
+
+def configure_cache(path: Optional[str] = "llm_cache.sqlite", max_bytes: Optional[int] = None,
+                    max_age: Optional[float] = None, replay: bool = False):
+    """
+    Enable the persistent LLM response cache (path None disables it)
+    :param max_bytes: evict least recently used responses beyond this size
+    :param max_age: drop responses older than this many seconds
+    :param replay: read-only mode; requests without a cached response raise `CacheMissError`
+    """
+    global response_cache, cache_replay
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = DiskCache(path, max_bytes, max_age, read_only=replay) if path else None
+    cache_replay = replay
+
+
+# Screenshot preparation for vision requests, see `configure_image_preparation`
+image_settings = {"max_image_tokens": None, "jpeg_quality": 85}
+image_payload_cache: Optional[DiskCache] = None
+_image_payloads: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_image_payloads_lock = threading.Lock()
+IMAGE_PATCH_PIXELS = 28 * 28  # pixels per visual token of qwen-vl
+LOW_DETAIL_SIDE = 512  # images that fit in one 512px tile are sent with detail "low"
+
+
+def configure_image_preparation(max_image_tokens: Optional[int] = None, jpeg_quality: int = 85,
+                                cache_path: Optional[str] = None, cache_max_bytes: Optional[int] = None):
+    """
+    Downsize screenshots of vision requests to a visual-token budget before upload
+    :param max_image_tokens: budget of visual tokens per image (None sends the original image)
+    :param jpeg_quality: JPEG quality of resized images
+    :param cache_path: SQLite file persisting the prepared payloads across runs
+    """
+    global image_payload_cache
+    image_settings.update(max_image_tokens=max_image_tokens, jpeg_quality=jpeg_quality)
+    with _image_payloads_lock:
+        _image_payloads.clear()
+    if image_payload_cache is not None:
+        image_payload_cache.close()
+    image_payload_cache = DiskCache(cache_path, max_bytes=cache_max_bytes) if cache_path else None
+
+
+def _resize_to_budget(image: IngestedImage) -> Tuple[bytes, str]:
+    """Scale the image down until it fits the visual-token budget; pick the detail level from its final size"""
+    budget = image_settings["max_image_tokens"]
+    if budget is None:
+        # sent as is, without decoding
+        return image.raw, "high"
+    pixels = image.rgb()
+    height, width = pixels.shape[:2]
+    data = image.raw
+    if width * height > budget * IMAGE_PATCH_PIXELS:
+        scale = (budget * IMAGE_PATCH_PIXELS / (width * height)) ** 0.5
+        width, height = max(1, int(width * scale)), max(1, int(height * scale))
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).resize((width, height), Image.LANCZOS).save(
+            buffer, format="JPEG", quality=image_settings["jpeg_quality"], optimize=True)
+        data = buffer.getvalue()
+    detail = "low" if max(width, height) <= LOW_DETAIL_SIDE else "high"
+    return data, detail
+
+
+def prepare_image(image_path: str) -> Tuple[str, str]:
+    """Base64 payload and detail level of a screenshot, cached by image content and preparation settings"""
+    key = content_key(image_ingest.digest(image_path), image_settings)
+    with _image_payloads_lock:
+        if key in _image_payloads:
+            _image_payloads.move_to_end(key)
+            return _image_payloads[key]
+    with span("image.prepare") as s:
+        payload = image_payload_cache.get(key) if image_payload_cache is not None else None
+        s.tag(cache_hit=payload is not None)
+        if payload is not None:
+            payload = tuple(payload)
+        else:
+            with image_ingest.hold(image_path) as image:
+                data, detail = _resize_to_budget(image)
+                payload = (base64.b64encode(data).decode("utf-8"), detail)
+                # drop the view of the mapped file before the image can be released
+                del data
+            s.tag(bytes=len(payload[0]), detail=detail)
+            if image_payload_cache is not None:
+                image_payload_cache.put(key, payload)
+    with _image_payloads_lock:
+        _image_payloads[key] = payload
+        if len(_image_payloads) > 64:
+            _image_payloads.popitem(last=False)
+    return payload
+
+
+def _cached_response(user_msg_txt: str, user_msg_img: Optional[str], system_msg: Optional[str], model: str,
+                     temperature: float, max_tokens: Optional[int] = None
+                     ) -> Tuple[Optional[str], Optional[Tuple[Dict[str, Any], int, int, float, float]]]:
+    """Cache key of a request (None if not cacheable) and its cached result, if any"""
+    if response_cache is None or temperature != 0.0:
+        return None, None
+    # the image is keyed by its content, not its path
+    img_hash = image_ingest.digest(user_msg_img) if user_msg_img is not None else None
+    img_settings = image_settings if user_msg_img is not None else None
+    cache_key = content_key(model, system_msg, user_msg_txt, img_hash, img_settings, temperature, max_tokens)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        logger.debug(f"LLM cache hit ({model})")
+        # nothing is paid for a cached response: its usage is reported at no cost
+        return cache_key, (cached["response"], cached["input_usage"], cached["output_usage"], 0.0, 0.0)
+    if cache_replay:
+        raise CacheMissError(f"no cached {model} response in replay mode")
+    return cache_key, None
+
+
+def build_messages(user_msg_txt: str, user_msg_img: Optional[str] = None,
+                   system_msg: Optional[str] = None) -> List[Dict[str, Any]]:
+    detail = "high"
     if user_msg_img is not None:
-        user_msg_img = encode_image(user_msg_img)
+        user_msg_img, detail = prepare_image(user_msg_img)
         user_msg_img = f"data:image/jpeg;base64,{user_msg_img}"
 
     messages = [{"role": "system", "content": system_msg}] if system_msg else []
     user_content = user_msg_txt if user_msg_img is None else [
         {"type": "text", "text": user_msg_txt},
-        {"type": "image_url", "image_url": {"url": user_msg_img, "detail": "high"}}
+        {"type": "image_url", "image_url": {"url": user_msg_img, "detail": detail}}
     ]
     messages.append({"role": "user", "content": user_content})
-    if model.startswith("gpt"):
-        response = gpt_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            response_format={"type": "json_object"}
-        )
-    else:
-        response = qwen_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            response_format={"type": "json_object"}
-        )
+    return messages
+
+
+def _parse_response(response, model: str, cache_key: Optional[str]) -> Tuple[Dict[str, Any], int, int, float, float]:
     response_content = response.choices[0].message.content
-    response_dict = json.loads(response_content)
+    with span("llm.parse"):
+        response_dict = json.loads(response_content)
     output_usage = response.usage.completion_tokens
     output_cost = output_usage * api_price[model]["output"]
     input_usage = response.usage.prompt_tokens
     input_cost = input_usage * api_price[model]["input"]
+    if cache_key is not None:
+        response_cache.put(cache_key, {"response": response_dict, "input_usage": input_usage,
+                                       "output_usage": output_usage})
     return response_dict, input_usage, output_usage, input_cost, output_cost
 
+
+def build_request_body(
+        user_msg_txt: str,
+        user_msg_img: Optional[str] = None,
+        system_msg: Optional[str] = None,
+        model: str = "gpt-4o-mini",
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Chat completion request body, as sent by `query` or written to a batch file"""
+    body = {
+        "model": model,
+        "messages": build_messages(user_msg_txt, user_msg_img, system_msg),
+        "temperature": temperature,
+        "response_format": {"type": "json_object"},
+    }
+    if max_tokens is not None:
+        body["max_tokens"] = max_tokens
+    return body
+
+
+def query(
+        user_msg_txt: str,
+        user_msg_img: Optional[str] = None,
+        system_msg: Optional[str] = None,
+        model: str = "gpt-4o-mini",
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+) -> Tuple[Dict[str, Any], int, int, float, float]:
+    with span("llm.query", model=model, image=user_msg_img is not None) as s:
+        cache_key, cached = _cached_response(user_msg_txt, user_msg_img, system_msg, model, temperature, max_tokens)
+        _cache_hit.set(cached is not None)
+        if cached is not None:
+            s.tag(cache_hit=True, input_tokens=cached[1], output_tokens=cached[2])
+            return cached
+        body = build_request_body(user_msg_txt, user_msg_img, system_msg, model, temperature, max_tokens)
+        # the request span includes the wait for a model slot and for the rate limiter
+        with span("llm.request", model=model), model_slots.get(model, nullcontext()):
+            response = client_for(model).complete(**body)
+        result = _parse_response(response, model, cache_key)
+        s.tag(cache_hit=False, input_tokens=result[1], output_tokens=result[2])
+        return result
+
+
+async def aquery(
+        user_msg_txt: str,
+        user_msg_img: Optional[str] = None,
+        system_msg: Optional[str] = None,
+        model: str = "gpt-4o-mini",
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+) -> Tuple[Dict[str, Any], int, int, float, float]:
+    """Awaitable version of `query` for asyncio callers"""
+    with span("llm.query", model=model, image=user_msg_img is not None) as s:
+        cache_key, cached = _cached_response(user_msg_txt, user_msg_img, system_msg, model, temperature, max_tokens)
+        _cache_hit.set(cached is not None)
+        if cached is not None:
+            s.tag(cache_hit=True, input_tokens=cached[1], output_tokens=cached[2])
+            return cached
+        body = build_request_body(user_msg_txt, user_msg_img, system_msg, model, temperature, max_tokens)
+        with span("llm.request", model=model):
+            response = await client_for(model).acomplete(**body)
+        result = _parse_response(response, model, cache_key)
+        s.tag(cache_hit=False, input_tokens=result[1], output_tokens=result[2])
+        return result
+
 def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    with image_ingest.hold(image_path) as image:
+        return base64.b64encode(image.raw).decode("utf-8")
 
 
 if __name__ == "__main__":
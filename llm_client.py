@@ -0,0 +1,180 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from logger import logger
+
+# Transient failures worth retrying; anything else (bad request, auth, ...) fails immediately
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` units per minute, holding at most `capacity` units"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        """Give back (delta > 0) or additionally charge (delta < 0) units once the real usage is known"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute quota of one model"""
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    async def acquire(self, estimated_tokens: int):
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        if self.tokens is not None:
+            self.tokens.adjust(estimated_tokens - used_tokens)
+
+
+def estimate_tokens(messages: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> int:
+    """Rough upper estimate of the tokens a request consumes, used to reserve TPM quota before sending it"""
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        parts = [content] if isinstance(content, str) else content
+        for part in parts:
+            if isinstance(part, str):
+                tokens += len(part)
+            elif part.get("type") == "text":
+                tokens += len(part["text"])
+            else:
+                tokens += 1500
+    return tokens + (max_tokens or 256)
+
+
+class AsyncLLMClient:
+    """
+    Chat completion client sharing one HTTP connection pool, with per-model RPM/TPM limits,
+    retries with jittered exponential backoff and an overall deadline per request.
+    All requests run on the client's own event loop; `complete` is the blocking entry point for threads.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None, max_connections: int = 64,
+                 max_retries: int = 6, backoff_base: float = 1.0, backoff_max: float = 60.0,
+                 request_timeout: float = 120.0, deadline: float = 600.0):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_timeout = request_timeout
+        self.deadline = deadline
+        self.limiters: Dict[str, RateLimiter] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.client: Optional[AsyncOpenAI] = None
+        self.lock = threading.Lock()
+
+    def set_rate_limit(self, model: str, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.limiters[model] = RateLimiter(rpm, tpm)
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="llm-client", daemon=True).start()
+        return self.loop
+
+    def _client(self) -> AsyncOpenAI:
+        # created lazily on the client's loop, which the pooled httpx client is bound to
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_connections)
+            self.client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0,
+                                      timeout=self.request_timeout, http_client=httpx.AsyncClient(limits=limits))
+        return self.client
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        # full jitter: uniform in [0, min(max, base * 2^attempt)]
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def _complete(self, model: str, messages: List[Dict[str, Any]], **kwargs):
+        limiter = self.limiters.get(model)
+        estimated = estimate_tokens(messages, kwargs.get("max_tokens"))
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"{model} request exceeded its {self.deadline}s deadline")
+            if limiter is not None:
+                await asyncio.wait_for(limiter.acquire(estimated), remaining)
+                remaining = deadline - time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    self._client().chat.completions.create(model=model, messages=messages, **kwargs),
+                    max(remaining, 0.001)
+                )
+            except RETRYABLE_ERRORS as e:
+                if limiter is not None:
+                    limiter.settle(estimated, 0)
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(self._backoff(attempt, e), max(deadline - time.monotonic(), 0))
+                logger.debug(f"{model} request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            if limiter is not None and response.usage is not None:
+                limiter.settle(estimated, response.usage.total_tokens)
+            return response
+
+    async def acomplete(self, model: str, messages: List[Dict[str, Any]], **kwargs):
+        """Awaitable from any event loop; the request itself runs on the client's loop"""
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._complete(model, messages, **kwargs), loop)
+        return await asyncio.wrap_future(future)
+
+    def complete(self, model: str, messages: List[Dict[str, Any]], **kwargs):
+        """Blocking chat completion, safe to call from many threads at once"""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._complete(model, messages, **kwargs), loop).result()
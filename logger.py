@@ -1,24 +1,184 @@
+import atexit
+import json
 import logging
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
 
 logging.basicConfig()
 logger = logging.getLogger("mylog")
 
+_report_buffer: ContextVar[Optional[List[logging.LogRecord]]] = ContextVar("report_buffer", default=None)
+_flush_lock = threading.Lock()
 
-def init_logger(_logger, filepath, mode="a"):
+
+class ReportBufferFilter(logging.Filter):
+    """Hold back records emitted inside `report_scope()` until the report finishes"""
+
+    def filter(self, record):
+        records = _report_buffer.get()
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+@contextmanager
+def capture_records():
+    """Collect the records emitted in this context instead of emitting them"""
+    records = []
+    token = _report_buffer.set(records)
+    try:
+        yield records
+    finally:
+        _report_buffer.reset(token)
+
+
+def replay_records(records: List[logging.LogRecord], _logger=logger):
+    """Emit previously captured records (into the enclosing report scope, if any)"""
+    buffer = _report_buffer.get()
+    if buffer is not None:
+        buffer.extend(records)
+        return
+    with _flush_lock:
+        for record in records:
+            _logger.handle(record)
+
+
+@contextmanager
+def report_scope(_logger=logger):
+    """Emit all log lines of one report as a contiguous block, even under concurrency"""
+    records = []
+    token = _report_buffer.set(records)
+    try:
+        yield
+    finally:
+        _report_buffer.reset(token)
+        replay_records(records, _logger)
+
+
+class StageLevelFilter(logging.Filter):
+    """
+    Drop records below the level set for their stage: the `stage` extra of the record or the function emitting
+    it, or else its module
+    """
+
+    def __init__(self, levels: Dict[str, int]):
+        super().__init__()
+        self.levels = levels
+
+    def filter(self, record):
+        level = self.levels.get(getattr(record, "stage", record.funcName))
+        if level is None:
+            level = self.levels.get(record.module)
+        return level is None or record.levelno >= level
+
+
+class RunIdFilter(logging.Filter):
+    """Stamp records with the id of the current run, see `set_run_id`"""
+
+    def filter(self, record):
+        record.run_id = _run_id
+        return True
+
+
+class HumanFormatter(logging.Formatter):
+    """The human-readable line, with the run id ("-" outside any run) after the logger name"""
+
+    def format(self, record):
+        record.run = getattr(record, "run_id", None) or "-"
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for machine consumption next to the human-readable log"""
+
+    def format(self, record):
+        return json.dumps({
+            "time": record.created, "level": record.levelname, "logger": record.name, "module": record.module,
+            "func": record.funcName, "stage": getattr(record, "stage", record.funcName), "thread": record.threadName,
+            "run_id": getattr(record, "run_id", None), "message": record.getMessage(),
+        }, ensure_ascii=False, default=str)
+
+
+_run_id: Optional[str] = None
+_listener: Optional[QueueListener] = None
+
+
+def set_run_id(run_id: Optional[str]):
+    """Id of the run stamped on every following record ("run_id" of the JSON log, "run <id>" of the human one)"""
+    global _run_id
+    _run_id = run_id
+
+
+def _file_handler(filepath: str, mode: str, max_bytes: int, backup_count: int) -> logging.Handler:
+    if max_bytes:
+        return RotatingFileHandler(filepath, mode=mode, maxBytes=max_bytes, backupCount=backup_count,
+                                   encoding="utf-8")
+    return logging.FileHandler(filepath, mode=mode, encoding="utf-8")
+
+
+def stop_logger():
+    """Write out the queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def init_logger(_logger, filepath, mode="a", json_path: Optional[str] = None, max_bytes: int = 0,
+                backup_count: int = 5, console_level: int = logging.DEBUG,
+                stage_levels: Optional[Dict[str, int]] = None):
+    """
+    Route `_logger` through a queue to a background writer thread, so logging never blocks on console or disk.
+    :param filepath: human-readable log file
+    :param json_path: also write every record as a JSON line to this file
+    :param max_bytes: rotate the log files beyond this size, keeping `backup_count` old files (0 never rotates)
+    :param console_level: minimum level printed to the console
+    :param stage_levels: minimum level per stage, keyed by function or module name, e.g. {"llm": logging.INFO}
+    """
+    global _listener
+    stop_logger()
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+    for log_filter in list(_logger.filters):
+        _logger.removeFilter(log_filter)
     _logger.setLevel(logging.DEBUG)
 
-    fmt = "%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(message)s"
-    formatter = logging.Formatter(fmt)
+    fmt = "%(asctime)s - %(levelname)s - %(name)s - run %(run)s - %(module)s - %(message)s"
+    formatter = HumanFormatter(fmt)
 
     console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
+    console.setLevel(console_level)
     console.setFormatter(formatter)
-    _logger.addHandler(console)
 
-    fout = logging.FileHandler(filepath, mode=mode)
+    fout = _file_handler(filepath, mode, max_bytes, backup_count)
     fout.setLevel(logging.DEBUG)
     fout.setFormatter(formatter)
-    _logger.addHandler(fout)
+    handlers = [console, fout]
+
+    if json_path:
+        fjson = _file_handler(json_path, mode, max_bytes, backup_count)
+        fjson.setLevel(logging.DEBUG)
+        fjson.setFormatter(JsonFormatter())
+        handlers.append(fjson)
+
+    # the calling thread only enqueues the record; formatting and writing happen in the listener thread
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(RunIdFilter())
+    _logger.addHandler(queue_handler)
+    _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    # verbosity is filtered before records are buffered by a report scope
+    if stage_levels:
+        _logger.addFilter(StageLevelFilter(stage_levels))
+    _logger.addFilter(ReportBufferFilter())
 
     # Do not propagate message to its ancestors.
     _logger.propagate = False
@@ -26,4 +186,5 @@ def init_logger(_logger, filepath, mode="a"):
     _logger.info('logger inited')
 
 
-init_logger(logger, "mylog.log", "a")
\ No newline at end of file
+init_logger(logger, "mylog.log", "a")
+atexit.register(stop_logger)
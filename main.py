@@ -1,14 +1,72 @@
-from typing import List
-
-from llm import query
-from logger import logger
-from ocr_detect import ocr_detect
-from utils import timeit, load_reports, download_img_from_url, dataset_base
+import argparse
+import contextvars
+import copy
+import json
+import logging
+import re
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import downloader
+from llm import query, take_cache_hit, set_concurrency_limit, set_rate_limit, configure_cache, \
+    configure_image_preparation
+from logger import logger, report_scope, capture_records, replay_records, init_logger, set_run_id
+from ocr_detect import ocr_detect, ocr_detector, OCR_MODEL_SPECS, TIERED_OCR_MODEL
+from cascade import Cascade
+from dataset import ReportDataset
+from image_ingest import image_ingest
+from store import ResultStore
+from tracing import span, tracer
+from utils import timeit, record_stage, collect_stage_outcomes, replay_stage_outcomes, share_stage, shared_stages, \
+    dataset_base
+
+
+def log_usage(in_use: int, out_use: int, in_cost: float, out_cost: float):
+    """Cost line of a stage; a response from the response cache cost nothing and is tagged [cached]"""
+    tag = "[cached] " if take_cache_hit() else ""
+    # attributed to the calling stage, for the per-stage log levels
+    logger.info(f"{tag}Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})",
+                stacklevel=2)
+
+
+def _log_speculative_waste(future: Future):
+    """
+    Log the cost lines of a speculative stage whose result went unused, marked "[speculative]". Called in the
+    report's context if the stage had already finished (the lines join its report block), else from the stage
+    pool once it finishes, outside any report.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    _, records, _ = future.result()
+    wasted = []
+    for record in records:
+        if "Input token" in record.getMessage():
+            record = copy.copy(record)
+            record.msg, record.args = f"[speculative] {record.getMessage()}", None
+            wasted.append(record)
+    replay_records(wasted)
 
 
 class RuleEngine:
 
-    def __init__(self):
+    def __init__(self, stage_workers: int = 8, cascade: Optional[Cascade] = None, verdict_only: bool = False,
+                 audit_rate: float = 0.0, verdict_max_tokens: int = 16):
+        # LLM and OCR backends of the stages (replaced when replaying recorded answers, see batch_mode.py)
+        self.query = query
+        self.ocr = ocr_detect
+        # Shared pool for the speculative stages of `run_speculative`
+        self.stage_pool = ThreadPoolExecutor(max_workers=stage_workers)
+        # Stage results answered ahead of time by batched prompts, keyed by (prompt name, user message)
+        self.prefetched: Dict[Tuple[str, str], dict] = {}
+        # Optional local classifiers answering the easy triage cases without an LLM call
+        self.cascade = cascade
+        # Verdict-only mode: boolean prompts ask for {result} alone under a hard output-token cap,
+        # except for the audit sample of reports, which keep the full prompt with its reason
+        self.verdict_only = verdict_only
+        self.audit_rate = audit_rate
+        self.verdict_max_tokens = verdict_max_tokens
 
         self.prompt1 = """You are a professional assistant reviewing crowdsourced test reports.
 You will be given a description of a test issue.
@@ -99,88 +157,134 @@ You will be given a description of a test issue and a corresponding screenshot.
 Check if the app GUI in screenshot is consistent with the described issue.
 Return a brief JSON response: {result: true/false, reason: <reason for your judgment>}"""
 
+        self.batch_suffix = """
+You will be given several inputs at once as a JSON array of {id, input} objects. Handle each input independently as described above.
+Return a JSON response: {results: [{id: <id>, %s}, ...]} with exactly one entry per input, in the given order."""
+
+        self.verdict_prompts = {
+            f"prompt{i}": re.sub(r"\{result: true/false, reason: <[^>]*>\}", "{result: true/false}",
+                                 getattr(self, f"prompt{i}"))
+            for i in (1, 2, 3, 4, 5, 7, 8, 9)
+        }
+
     @timeit
+    @record_stage
+    @share_stage
     def visible_in_screenshot(self, report_txt: str) -> bool:
         """区分报告的bug是否存在显式的界面表现"""
+        result = self.cascade.decide("visible_in_screenshot", report_txt) if self.cascade else None
+        if result is None:
+            result = self.prefetched.get(("prompt1", report_txt))
+        if result is not None:
+            logger.info(result)
+            return result["result"]
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, system_msg=self.prompt1, model="qwen-plus")
+            self.query(user_msg_txt=report_txt, **self._boolean_prompt("prompt1", report_txt), model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def verify_invisible_in_screenshot(self, report_txt: str, screen_txt: List[str]) -> bool:
         """根据OCR识别结果验证报告的bug是否存在显式的界面表现"""
         prompt = f"Description: {report_txt}\nText Snippets: [{','.join(t for t in screen_txt)}]"
+        result = self.prefetched.get(("prompt5", prompt))
+        if result is not None:
+            logger.info(result)
+            return not result["result"]
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=prompt, system_msg=self.prompt5, model="qwen-plus")
+            self.query(user_msg_txt=prompt, **self._boolean_prompt("prompt5", report_txt), model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return not result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def direct_reflect_from_ui_text(self, report_txt: str) -> bool:
         """判断是否能仅通过文本语义匹配来确认一致性"""
+        result = self.cascade.decide("direct_reflect_from_ui_text", report_txt) if self.cascade else None
+        if result is None:
+            result = self.prefetched.get(("prompt2", report_txt))
+        if result is not None:
+            logger.info(result)
+            return result["result"]
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, system_msg=self.prompt2, model="qwen-plus")
+            self.query(user_msg_txt=report_txt, **self._boolean_prompt("prompt2", report_txt), model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def detect_consistency_by_ui_text(self, report_txt: str, candidates: List[str]) -> bool:
         """使用OCR识别结果进行文本语义匹配来检测一致性"""
         prompt = f"Description: {report_txt}\nOCR Result: [{','.join(t for t in candidates)}]"
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=prompt, system_msg=self.prompt3, model="qwen-plus")
+            self.query(user_msg_txt=prompt, **self._boolean_prompt("prompt3", report_txt), model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def detect_consistency_by_vision(self, report_txt: str, report_img: str) -> bool:
         """使用MLLM直接进行bug的显式界面特征匹配来检测一致性"""
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, user_msg_img=report_img, system_msg=self.prompt4, model="qwen-vl-max")
+            self.query(user_msg_txt=report_txt, user_msg_img=report_img, **self._boolean_prompt("prompt4", report_txt), model="qwen-vl-max")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def describe_app_state_by_ocr_result(self, screen_txt: List[str]) -> str:
         """根据OCR识别结果来描述截图所展示的页面状态"""
         prompt = f"[{','.join(t for t in screen_txt)}]"
+        result = self.prefetched.get(("prompt6", prompt))
+        if result is not None:
+            logger.info(result)
+            return result["description"]
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=prompt, system_msg=self.prompt6, model="qwen-plus")
+            self.query(user_msg_txt=prompt, system_msg=self.prompt6, model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["description"]
 
     @timeit
+    @record_stage
+    @share_stage
     def detect_consistency_by_visual_state(self, report_txt: str, report_img: str) -> str:
         """根据截图所展示的页面状态来检测一致性"""
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, user_msg_img=report_img, system_msg=self.prompt7, model="qwen-vl-max")
+            self.query(user_msg_txt=report_txt, user_msg_img=report_img, **self._boolean_prompt("prompt7", report_txt), model="qwen-vl-max")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
+    @record_stage
+    @share_stage
     def detect_consistency_by_textual_state(self, report_txt: str, description: str) -> bool:
         """根据页面状态的文本描述来检测一致性"""
         prompt = f"Test Issue: {report_txt}\nApp State: {description}"
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=prompt, system_msg=self.prompt8, model="qwen-plus")
+            self.query(user_msg_txt=prompt, **self._boolean_prompt("prompt8", report_txt), model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
     def preprocess(self, report_txt: str) -> bool:
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, system_msg=self.prompt0, model="qwen-plus")
+            self.query(user_msg_txt=report_txt, system_msg=self.prompt0, model="qwen-plus")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         return result["result"]
 
     @timeit
@@ -189,12 +293,12 @@ Return a brief JSON response: {result: true/false, reason: <reason for your judg
         if visible:
             text_exist = self.direct_reflect_from_ui_text(report_txt)
             if text_exist:
-                candidates = ocr_detect(report_img)
+                candidates = self.ocr(report_img)
                 consistent = self.detect_consistency_by_ui_text(report_txt, candidates)
             else:
                 consistent = self.detect_consistency_by_vision(report_txt, report_img)
         else:
-            screen_txt = ocr_detect(report_img)
+            screen_txt = self._screen_text(report_img)
             invisible = self.verify_invisible_in_screenshot(report_txt, screen_txt)
             if not invisible:
                 consistent = True
@@ -206,11 +310,178 @@ Return a brief JSON response: {result: true/false, reason: <reason for your judg
         logger.info(f"Report #{report_id} Consistent? {consistent}")
         return consistent
 
+    def _screen_text(self, report_img: str) -> List[str]:
+        """OCR of a screenshot, taken from `prefetch_app_states` if it already ran there"""
+        prefetched = self.prefetched.get(("ocr", report_img))
+        return prefetched["text"] if prefetched is not None else self.ocr(report_img)
+
+    def _audited(self, report_txt: str) -> bool:
+        """Deterministic sample of reports whose boolean stages keep their reason in verdict-only mode"""
+        return zlib.crc32(report_txt.encode("utf-8")) % 10000 < self.audit_rate * 10000
+
+    def _boolean_prompt(self, prompt_name: str, report_txt: str) -> dict:
+        """System prompt and output cap of a boolean stage"""
+        if not self.verdict_only or self._audited(report_txt):
+            return {"system_msg": getattr(self, prompt_name)}
+        return {"system_msg": self.verdict_prompts[prompt_name], "max_tokens": self.verdict_max_tokens}
+
+    def _query_batch(self, prompt_name: str, inputs: List[str], fields: Tuple[str, ...]) -> Optional[List[dict]]:
+        """Answer a text-only prompt for several inputs in one request; None if the response is malformed"""
+        field_spec = ", ".join("result: true/false" if f == "result" else f"{f}: <{f}>" for f in fields)
+        system_msg = self.verdict_prompts.get(prompt_name, getattr(self, prompt_name)) if self.verdict_only \
+            else getattr(self, prompt_name)
+        system_msg += self.batch_suffix % field_spec
+        prompt = json.dumps([{"id": i, "input": t} for i, t in enumerate(inputs)], ensure_ascii=False)
+        try:
+            result, in_use, out_use, in_cost, out_cost = \
+                self.query(user_msg_txt=prompt, system_msg=system_msg, model="qwen-plus")
+        except Exception as e:
+            logger.warning(f"Batched {prompt_name} for {len(inputs)} inputs failed -- {e}")
+            return None
+        logger.info(f"Batched {prompt_name} for {len(inputs)} inputs")
+        log_usage(in_use, out_use, in_cost, out_cost)
+        items = result.get("results") if isinstance(result, dict) else None
+        if not isinstance(items, list) or len(items) != len(inputs):
+            logger.warning(f"Malformed batched {prompt_name} response, falling back to per-report calls")
+            return None
+        answers = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or item.get("id") != i or any(f not in item for f in fields):
+                logger.warning(f"Malformed batched {prompt_name} response, falling back to per-report calls")
+                return None
+            answers.append({f: item[f] for f in fields})
+        return answers
+
+    def prefetch(self, prompt_name: str, inputs: List[str], batch_size: int):
+        """Answer prompt 1, 2, 5 or 6 for many inputs with batched requests; stage methods then reuse the answers"""
+        if prompt_name == "prompt6":
+            fields = ("description",)
+        elif self.verdict_only:
+            # audit samples are left to the per-report calls, which keep the reason
+            fields = ("result",)
+            inputs = [t for t in inputs if not self._audited(t)]
+        else:
+            fields = ("result", "reason")
+        inputs = list(dict.fromkeys(t for t in inputs if (prompt_name, t) not in self.prefetched))
+        batches = [inputs[i:i + batch_size] for i in range(0, len(inputs), batch_size)]
+        futures = [self.stage_pool.submit(self._query_batch, prompt_name, batch, fields) for batch in batches]
+        for batch, future in zip(batches, futures):
+            answers = future.result()
+            if answers is None:
+                continue
+            for txt, answer in zip(batch, answers):
+                self.prefetched[(prompt_name, txt)] = answer
+
+    def _local_answers(self, stage: str, report_txts: List[str]) -> Dict[str, dict]:
+        """Answers of the cascade for the reports it decides confidently"""
+        if self.cascade is None:
+            return {}
+        answers = {t: self.cascade.answer(stage, t) for t in report_txts}
+        return {t: answer for t, answer in answers.items() if answer is not None}
+
+    def prefetch_triage(self, report_txts: List[str], batch_size: int):
+        """
+        Batch the visibility (prompt 1) and text-reflection (prompt 2) triage of many reports.
+        Reports the cascade answers confidently are left out of the batches, as they never reach the LLM.
+        """
+        local = self._local_answers("visible_in_screenshot", report_txts)
+        self.prefetch("prompt1", [t for t in report_txts if t not in local], batch_size)
+        visible = [t for t in report_txts
+                   if (local.get(t) or self.prefetched.get(("prompt1", t), {})).get("result", True)]
+        local = self._local_answers("direct_reflect_from_ui_text", visible)
+        self.prefetch("prompt2", [t for t in visible if t not in local], batch_size)
+
+    def prefetch_app_states(self, reports: List[dict], batch_size: int):
+        """
+        Batch the text-only stages of the invisible-bug path of `run`, after `prefetch_triage`: the reports
+        prompt 1 found invisible are OCRed (which that path does anyway), prompt 5 is batched over their OCR
+        text, and prompt 6 over the OCR text of those prompt 5 confirms invisible.
+        """
+        local = self._local_answers("visible_in_screenshot", [report["description"] for report in reports])
+        invisible = [(report["description"], str(dataset_base / "images" / f"{report['index']}.jpg"))
+                     for report in reports
+                     if not (local.get(report["description"]) or
+                             self.prefetched.get(("prompt1", report["description"]), {"result": True}))["result"]]
+        futures = [(txt, img, self.stage_pool.submit(self.ocr, img)) for txt, img in invisible]
+        screens = []
+        for txt, img, future in futures:
+            try:
+                screen_txt = future.result()
+            except Exception as e:
+                # left to the report's own analysis, which reports the failure
+                logger.debug(f"OCR of {img} failed while prefetching -- {e}")
+                continue
+            self.prefetched[("ocr", img)] = {"text": screen_txt}
+            if self.verdict_only and self._audited(txt):
+                # audit samples keep the reason: their prompt 5 is asked per report
+                continue
+            screens.append((f"Description: {txt}\nText Snippets: [{','.join(t for t in screen_txt)}]", screen_txt))
+        self.prefetch("prompt5", [prompt for prompt, _ in screens], batch_size)
+        still_invisible = [screen_txt for prompt, screen_txt in screens
+                           if not self.prefetched.get(("prompt5", prompt), {"result": True})["result"]]
+        self.prefetch("prompt6", [f"[{','.join(t for t in screen_txt)}]" for screen_txt in still_invisible],
+                      batch_size)
+
+    def _speculate(self, func, *args) -> Future:
+        """Start a stage in the background; its log lines are held until the result is used"""
+        def task():
+            with capture_records() as records, collect_stage_outcomes() as outcomes:
+                value = func(*args)
+            return value, records, outcomes
+        return self.stage_pool.submit(contextvars.copy_context().run, task)
+
+    @staticmethod
+    def _resolve(future: Future, resolved: set):
+        resolved.add(future)
+        value, records, outcomes = future.result()
+        replay_records(records)
+        replay_stage_outcomes(outcomes)
+        return value
+
+    @staticmethod
+    def _discard(future: Future):
+        """Drop an unused stage: cancelled if still queued, else its requests were paid for and are logged"""
+        if not future.cancel():
+            future.add_done_callback(_log_speculative_waste)
+
+    @timeit
+    def run_speculative(self, report_id: str, report_txt: str, report_img: str):
+        """Same decision tree as `run`, but prompt 1, prompt 2 and OCR are started at once"""
+        visible_future = self._speculate(self.visible_in_screenshot, report_txt)
+        text_exist_future = self._speculate(self.direct_reflect_from_ui_text, report_txt)
+        ocr_future = self._speculate(self._screen_text, report_img)
+        resolved = set()
+        try:
+            visible = self._resolve(visible_future, resolved)
+            if visible:
+                text_exist = self._resolve(text_exist_future, resolved)
+                if text_exist:
+                    candidates = self._resolve(ocr_future, resolved)
+                    consistent = self.detect_consistency_by_ui_text(report_txt, candidates)
+                else:
+                    consistent = self.detect_consistency_by_vision(report_txt, report_img)
+            else:
+                screen_txt = self._resolve(ocr_future, resolved)
+                invisible = self.verify_invisible_in_screenshot(report_txt, screen_txt)
+                if not invisible:
+                    consistent = True
+                else:
+                    description = self.describe_app_state_by_ocr_result(screen_txt)
+                    consistent = self.detect_consistency_by_textual_state(report_txt, description)
+                    if not consistent:
+                        consistent = self.detect_consistency_by_visual_state(report_txt, report_img)
+        finally:
+            for future in (visible_future, text_exist_future, ocr_future):
+                if future not in resolved:
+                    self._discard(future)
+        logger.info(f"Report #{report_id} Consistent? {consistent}")
+        return consistent
+
     @timeit
     def run_without_check_visibility(self, report_id: str, report_txt: str, report_img: str):
         text_exist = self.direct_reflect_from_ui_text(report_txt)
         if text_exist:
-            candidates = ocr_detect(report_img)
+            candidates = self.ocr(report_img)
             consistent = self.detect_consistency_by_ui_text(report_txt, candidates)
         else:
             consistent = self.detect_consistency_by_vision(report_txt, report_img)
@@ -233,12 +504,12 @@ Return a brief JSON response: {result: true/false, reason: <reason for your judg
         if visible:
             text_exist = self.direct_reflect_from_ui_text(report_txt)
             if text_exist:
-                candidates = ocr_detect(report_img)
+                candidates = self.ocr(report_img)
                 consistent = self.detect_consistency_by_ui_text(report_txt, candidates)
             else:
                 consistent = self.detect_consistency_by_vision(report_txt, report_img)
         else:
-            screen_txt = ocr_detect(report_img)
+            screen_txt = self.ocr(report_img)
             description = self.describe_app_state_by_ocr_result(screen_txt)
             consistent = self.detect_consistency_by_textual_state(report_txt, description)
             if not consistent:
@@ -249,36 +520,218 @@ Return a brief JSON response: {result: true/false, reason: <reason for your judg
     @timeit
     def run_with_bare_llm(self, report_id: str, report_txt: str, report_img: str):
         result, in_use, out_use, in_cost, out_cost = \
-            query(user_msg_txt=report_txt, user_msg_img=report_img, system_msg=self.prompt9, model="qwen-vl-max")
+            self.query(user_msg_txt=report_txt, user_msg_img=report_img, **self._boolean_prompt("prompt9", report_txt), model="qwen-vl-max")
         logger.info(result)
-        logger.info(f"Input token: {in_use} (${in_cost:6f}); Output token: {out_use} (${out_cost:6f})")
+        log_usage(in_use, out_use, in_cost, out_cost)
         logger.info(f"Report #{report_id} Consistent? {result['result']}")
         return result["result"]
 
+    def run_ablation(self, report_id: str, report_txt: str, report_img: str, variants: List[str]) -> Dict[str, dict]:
+        """
+        Evaluate several pipeline variants (e.g. "run", "run_without_using_ocr") on one report in a single pass.
+        Each stage is computed at most once and its result is shared by all variants that need it; the stage's log
+        lines are repeated, marked "[shared]", in the block of every later variant using it.
+        :return: {variant: {"verdict": bool, "stages": [(stage, outcome), ...]}} for the variants that succeeded
+        """
+        results = {}
+        with shared_stages():
+            for variant in variants:
+                error = None
+                with capture_records() as records, collect_stage_outcomes() as stages:
+                    try:
+                        consistent = getattr(self, variant)(report_id, report_txt, report_img)
+                    except Exception as e:
+                        error = e
+                # replayed once the capture has ended, so they reach the report scope instead of the capture
+                replay_records([r for r in records if "Consistent?" not in r.getMessage()])
+                if error is not None:
+                    logger.warning(f"[{variant}] Analysis for Report #{report_id} failed -- {error}")
+                    continue
+                results[variant] = {"verdict": consistent, "stages": stages}
+                # right after the variant's stage lines, so the analysis attributes them to this variant
+                logger.info(f"[{variant}] Report #{report_id} Consistent? {consistent}")
+        return results
+
     @staticmethod
-    def download_dataset():
-        dataset = load_reports()
-        for item in dataset:
-            download_img_from_url(item["img_url"], item["index"])
+    def download_dataset(workers: int = 8):
+        """Fetch the screenshots not downloaded yet, see `downloader.Downloader`"""
+        return downloader.download_dataset(ReportDataset(), str(dataset_base / "images"), workers)
 
 
-def main():
-    re = RuleEngine()
-    # re.download_dataset()
-    reports = load_reports()
-    for report in reports:
-        idx = report["index"]
-        text = report["description"]
-        img = str(dataset_base / "images" / f"{idx}.jpg")
+VARIANTS = ["run", "run_speculative", "run_without_check_visibility", "run_without_using_ocr",
+            "run_without_verify_visibility", "run_with_bare_llm"]
+
+
+def variant_run_id(run_id: str, variant: str, variants: List[str]) -> str:
+    """Results of an ablation pass are stored as one run per variant"""
+    return run_id if len(variants) == 1 else f"{run_id}/{variant}"
+
+
+def analyze_report(re: RuleEngine, report: dict, variants: List[str],
+                   store: Optional[ResultStore] = None, run_id: Optional[str] = None) -> Optional[Dict[str, dict]]:
+    """Analyze one report; returns {variant: {"verdict", "stages"}}, or None if the analysis failed"""
+    idx = report["index"]
+    text = report["description"]
+    img = str(dataset_base / "images" / f"{idx}.jpg")
+    # the screenshot is read and decoded once for all stages of the report, and released with it
+    with report_scope(), image_ingest.hold(img), span("report", report=idx):
         try:
-            re.run(idx, text, img)
-            # re.run_without_using_ocr(idx, text, img)
-            # re.run_without_check_visibility(idx, text, img)
-            # re.run_without_verify_visibility(idx, text, img)
-            # re.run_with_bare_llm(idx, text, img)
+            if len(variants) == 1:
+                with collect_stage_outcomes() as stages:
+                    consistent = getattr(re, variants[0])(idx, text, img)
+                results = {variants[0]: {"verdict": consistent, "stages": stages}}
+            else:
+                results = re.run_ablation(idx, text, img, variants)
+            if store is not None:
+                for variant, result in results.items():
+                    store.save(variant_run_id(run_id, variant, variants), idx, result["verdict"], result["stages"])
+            return results
         except Exception as e:
             logger.warning(f"Analysis for Report #{idx} failed -- {e}")
+            return None
+
+
+def main(workers: int = 1, qwen_plus_limit: Optional[int] = None, qwen_vl_max_limit: Optional[int] = None,
+         variants: Optional[List[str]] = None, batch_size: int = 1, run_id: Optional[str] = None,
+         store_path: Optional[str] = "results.sqlite", resume: bool = False,
+         cascade_path: Optional[str] = None, cascade_threshold: float = 0.95,
+         verdict_only: bool = False, audit_rate: float = 0.0, shard: Tuple[int, int] = (0, 1)):
+    """
+    Analyze every report of the dataset (or of one shard of it)
+    :param workers: number of reports in flight at once
+    :param qwen_plus_limit: maximum concurrent requests to qwen-plus (default: unbounded)
+    :param qwen_vl_max_limit: maximum concurrent requests to qwen-vl-max (default: unbounded)
+    :param variants: pipeline variants to evaluate (default: ["run"]); several variants are evaluated in one
+        ablation pass that shares stage results
+    :param batch_size: number of reports packed into one triage request (1 disables batching)
+    :param run_id: id under which results are stored (default: current time)
+    :param store_path: SQLite file recording the per-report results (None disables it)
+    :param resume: skip the reports already finished in run `run_id`
+    :param cascade_path: trained local triage classifiers (see cascade.py); None always queries the LLM
+    :param cascade_threshold: minimum classifier confidence to skip the LLM call
+    :param verdict_only: boolean stages return the verdict without a reason, under a hard output-token cap
+    :param audit_rate: fraction of reports that keep the reasons in verdict-only mode
+    :param shard: (i, n) to analyze only the reports whose index is i modulo n, e.g. one of n machines
+    """
+    set_concurrency_limit("qwen-plus", qwen_plus_limit)
+    set_concurrency_limit("qwen-vl-max", qwen_vl_max_limit)
+    variants = variants or ["run"]
+    cascade = Cascade.load(cascade_path, cascade_threshold) if cascade_path else None
+    re = RuleEngine(stage_workers=3 * max(workers, 1), cascade=cascade, verdict_only=verdict_only,
+                    audit_rate=audit_rate)
+    # re.download_dataset()
+    reports = ReportDataset().shard(*shard)
+    run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+    set_run_id(run_id)
+    store = ResultStore(store_path) if store_path else None
+    if resume and store is not None:
+        finished = set.intersection(*(store.finished(variant_run_id(run_id, v, variants)) for v in variants))
+        reports = reports.exclude(finished)
+        logger.info(f"Resuming run {run_id}: {len(finished)} reports done, {len(reports)} remaining")
+    else:
+        logger.info(f"Run {run_id} started")
+    # reports are read chunk by chunk, so memory stays flat whatever the dataset size
+    chunk_size = batch_size * max(workers, 1) if batch_size > 1 else 64 * max(workers, 1)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for chunk in reports.chunks(chunk_size):
+            if batch_size > 1:
+                re.prefetch_triage([report["description"] for report in chunk], batch_size)
+                if any(variant in ("run", "run_speculative") for variant in variants):
+                    re.prefetch_app_states(chunk, batch_size)
+            if workers <= 1:
+                for report in chunk:
+                    analyze_report(re, report, variants, store, run_id)
+            else:
+                for _ in pool.map(lambda report: analyze_report(re, report, variants, store, run_id), chunk):
+                    pass
+            re.prefetched.clear()
+    if store is not None:
+        store.close()
+    if cascade is not None:
+        cascade.log_summary()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of reports analyzed concurrently")
+    parser.add_argument("--qwen-plus-limit", type=int, default=None, help="max concurrent qwen-plus requests")
+    parser.add_argument("--qwen-vl-max-limit", type=int, default=None, help="max concurrent qwen-vl-max requests")
+    parser.add_argument("--variants", default="run",
+                        help=f"comma-separated pipeline variants evaluated in one pass, from: {','.join(VARIANTS)}")
+    parser.add_argument("--batch-size", type=int, default=1, help="reports per batched triage request")
+    parser.add_argument("--run-id", default=None, help="id of the run in the result store (default: current time)")
+    parser.add_argument("--store", default="results.sqlite", help="SQLite file of per-report results")
+    parser.add_argument("--resume", action="store_true", help="skip reports already finished in --run-id")
+    parser.add_argument("--cascade", default=None, help="local triage classifiers trained with cascade.py")
+    parser.add_argument("--cascade-threshold", type=float, default=0.95, help="confidence to answer triage locally")
+    parser.add_argument("--verdict-only", action="store_true", help="skip the reason of boolean stages")
+    parser.add_argument("--audit-rate", type=float, default=0.0, help="fraction of reports keeping reasons")
+    parser.add_argument("--shard", default="0/1", metavar="I/N", help="only analyze the reports of index I modulo N")
+    parser.add_argument("--llm-cache", default=None, help="SQLite file caching LLM responses across runs")
+    parser.add_argument("--llm-cache-max-mb", type=float, default=None, help="evict cached responses beyond this size")
+    parser.add_argument("--llm-cache-max-age-days", type=float, default=None, help="drop cached responses older than this")
+    parser.add_argument("--llm-cache-replay", action="store_true", help="only answer from the cache, never query")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="MODEL=RPM:TPM",
+                        help="per-model requests/tokens per minute quota, e.g. qwen-plus=1200:1000000")
+    parser.add_argument("--image-token-budget", type=int, default=None,
+                        help="downsize screenshots to at most this many visual tokens (default: original image)")
+    parser.add_argument("--image-quality", type=int, default=85, help="JPEG quality of downsized screenshots")
+    parser.add_argument("--image-cache", default=None, help="SQLite file caching prepared screenshot payloads")
+    parser.add_argument("--ocr-cache", default=None, help="SQLite file caching OCR results across runs")
+    parser.add_argument("--ocr-cache-max-mb", type=float, default=None, help="evict cached OCR results beyond this size")
+    parser.add_argument("--ocr-model", default=ocr_detector.ocr_model, choices=list(OCR_MODEL_SPECS) + [TIERED_OCR_MODEL],
+                        help="OCR pipeline; the tiered one re-reads low-confidence lines with the server recognizer")
+    parser.add_argument("--ocr-tile-height", type=int, default=None,
+                        help="OCR taller screenshots as overlapping tiles of this height (default: whole image)")
+    parser.add_argument("--ocr-tile-overlap", type=int, default=200, help="overlap of OCR tiles in pixels")
+    parser.add_argument("--ocr-tile-workers", type=int, default=2, help="OCR tiles recognized in parallel")
+    parser.add_argument("--ocr-idle-unload", type=float, default=None, metavar="SECONDS",
+                        help="unload OCR pipelines unused for this long, e.g. the accurate one of the tiered model")
+    parser.add_argument("--log-file", default="mylog.log", help="human-readable log file")
+    parser.add_argument("--log-json", default=None, help="also write every log record as a JSON line to this file")
+    parser.add_argument("--log-max-mb", type=float, default=0, help="rotate the log files beyond this size")
+    parser.add_argument("--log-backups", type=int, default=5, help="rotated log files kept")
+    parser.add_argument("--console-level", default="DEBUG", help="minimum level printed to the console")
+    parser.add_argument("--stage-log-level", action="append", default=[], metavar="STAGE=LEVEL",
+                        help="minimum level of a stage (function or module name), e.g. llm_client=WARNING")
+    parser.add_argument("--trace", default=None, help="record stage spans and write them as JSON lines to this file")
+    parser.add_argument("--trace-chrome", default=None, help="also write the spans in Chrome trace format")
+    args = parser.parse_args()
+    init_logger(logger, args.log_file, json_path=args.log_json, max_bytes=int(args.log_max_mb * 2 ** 20),
+                backup_count=args.log_backups, console_level=logging.getLevelName(args.console_level.upper()),
+                stage_levels={stage: logging.getLevelName(level.upper()) for stage, _, level in
+                              (spec.partition("=") for spec in args.stage_log_level)})
+    if args.trace or args.trace_chrome:
+        tracer.enable()
+    ocr_detector.ocr_model = args.ocr_model
+    ocr_detector.idle_timeout = args.ocr_idle_unload
+    try:
+        ocr_detector.configure_tiling(args.ocr_tile_height, args.ocr_tile_overlap, args.ocr_tile_workers)
+    except ValueError as e:
+        parser.error(str(e))
+    ocr_detector.configure_cache(args.ocr_cache,
+                                 max_bytes=int(args.ocr_cache_max_mb * 2 ** 20) if args.ocr_cache_max_mb else None)
+    configure_image_preparation(args.image_token_budget, args.image_quality, args.image_cache)
+    for spec in args.rate_limit:
+        model, _, quota = spec.partition("=")
+        rpm, _, tpm = quota.partition(":")
+        set_rate_limit(model, float(rpm) if rpm else None, float(tpm) if tpm else None)
+    if args.llm_cache:
+        configure_cache(args.llm_cache,
+                        max_bytes=int(args.llm_cache_max_mb * 2 ** 20) if args.llm_cache_max_mb else None,
+                        max_age=args.llm_cache_max_age_days * 86400 if args.llm_cache_max_age_days else None,
+                        replay=args.llm_cache_replay)
+    if args.resume and args.run_id is None:
+        parser.error("--resume requires --run-id")
+    variants = args.variants.split(",")
+    if any(v not in VARIANTS for v in variants):
+        parser.error(f"--variants must be chosen from {','.join(VARIANTS)}")
+    main(args.workers, args.qwen_plus_limit, args.qwen_vl_max_limit, variants, args.batch_size,
+         args.run_id, args.store, args.resume, args.cascade, args.cascade_threshold, args.verdict_only,
+         args.audit_rate, tuple(int(part) for part in args.shard.split("/")))
+    if tracer.enabled:
+        logger.info(f"Stage latency:\n{tracer.format_stats()}")
+        if args.trace:
+            tracer.export_jsonl(args.trace)
+        if args.trace_chrome:
+            tracer.export_chrome(args.trace_chrome)
@@ -1,61 +1,21 @@
+import gc
 import os
 import re
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 from pathlib import Path
 
 import cv2
 import numpy as np
-from PIL import Image
-from paddleocr import PaddleOCR
-
-from utils import Text, timeit
-
-
-def text_sentences_recognition(texts: List[Text]) -> List[Text]:
-    """Merge separate words into a sentence"""
-    changed = True
-    while changed:
-        changed = False
-        temp_set = []
-        for text_a in texts:
-            merged = False
-            for text_b in temp_set:
-                if text_a.is_on_same_line(
-                        text_b, "h",
-                        bias_justify=0.2 * min(text_a.height, text_b.height),
-                        bias_gap=2 * max(text_a.word_width, text_b.word_width)
-                ):
-                    text_b.merge_text(text_a)
-                    merged = True
-                    changed = True
-                    break
-            if not merged:
-                temp_set.append(text_a)
-        texts = temp_set.copy()
-
-    for i, text in enumerate(texts):
-        text.id = i
-    return texts
-
 
-def merge_intersected_texts(texts: List[Text]) -> List[Text]:
-    """Merge intersected texts (sentences or words)"""
-    changed = True
-    while changed:
-        changed = False
-        temp_set = []
-        for text_a in texts:
-            merged = False
-            for text_b in temp_set:
-                if text_a.is_intersected(text_b, bias=2):
-                    text_b.merge_text(text_a)
-                    merged = True
-                    changed = True
-                    break
-            if not merged:
-                temp_set.append(text_a)
-        texts = temp_set.copy()
-    return texts
+from cache import DiskCache, content_key
+from image_ingest import image_ingest
+from logger import logger
+from text_merge import merge_intersected_boxes, merge_sentence_boxes
+from tracing import span
+from utils import Text, TextBoxes, timeit, share_stage, current_rss_mb
 
 
 def text_cvt_orc_format(ocr_result):
@@ -85,77 +45,293 @@ def text_cvt_orc_format(ocr_result):
 
 
 def text_cvt_orc_format_paddle(paddle_result):
-    texts = []
-    if paddle_result is not None:
-        for i, line in enumerate(paddle_result):
-            points = np.array(line[0])
-            location = {
-                "left": int(min(points[:, 0])),
-                "top": int(min(points[:, 1])),
-                "right": int(max(points[:, 0])),
-                "bottom": int(max(points[:, 1])),
-            }
-            content = line[1][0]
-            texts.append(Text(i, content, location))
-    return texts
+    return TextBoxes.from_paddle(paddle_result).texts()
+
+
+# (lang, det model, cls model, rec model) of every OCR pipeline shipped in ocr_models/
+OCR_MODEL_SPECS = {
+    "chinese_cht_mobile_v2.0": ("chinese_cht", "ch_ppocr_mobile_v2.0_det_infer",
+                                "ch_ppocr_mobile_v2.0_cls_infer", "chinese_cht_mobile_v2.0_rec_infer"),
+    "ch_ppocr_mobile_v2.0_xx": ("ch", "ch_ppocr_mobile_v2.0_det_infer",
+                                "ch_ppocr_mobile_v2.0_cls_infer", "ch_ppocr_mobile_v2.0_rec_infer"),
+    "ch_PP-OCRv2_xx": ("ch", "ch_PP-OCRv2_det_infer",
+                       "ch_ppocr_mobile_v2.0_cls_infer", "ch_PP-OCRv2_rec_infer"),
+    "ch_ppocr_server_v2.0_xx": ("ch", "ch_ppocr_server_v2.0_det_infer",
+                                "ch_ppocr_mobile_v2.0_cls_infer", "ch_ppocr_server_v2.0_rec_infer"),
+}
+DEFAULT_OCR_MODEL = "ch_ppocr_server_v2.0_xx"
+# Tiered pipelines are named "fast+accurate": the fast pipeline reads the whole image, the accurate recognizer
+# re-reads only the lines the fast one is unsure about
+TIERED_OCR_MODEL = "ch_ppocr_mobile_v2.0_xx+ch_ppocr_server_v2.0_xx"
+
+
+def crop_text_region(pixels: np.ndarray, points) -> np.ndarray:
+    """Perspective-corrected crop of a detected text box, the way Paddle crops boxes for recognition"""
+    points = np.array(points, dtype=np.float32)
+    width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    target = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    crop = cv2.warpPerspective(pixels, cv2.getPerspectiveTransform(points, target), (width, height),
+                               borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC)
+    if crop.shape[0] >= 1.5 * crop.shape[1]:
+        crop = np.rot90(crop)
+    return crop
 
 
 class OCRDetector:
-    def __init__(self):
+    def __init__(self, idle_timeout: Optional[float] = None, model_options: Optional[dict] = None):
+        """
+        OCR pipelines are loaded on first use only
+        :param idle_timeout: unload a pipeline that has not been used for this many seconds (None keeps them loaded)
+        :param model_options: PaddleOCR arguments overriding the defaults (e.g. cpu_threads, rec_batch_num)
+        """
         self.threshold = 0.8
+        # pipeline used by `detect` by default: one of OCR_MODEL_SPECS or a tiered "fast+accurate" name
+        self.ocr_model = "ch_ppocr_mobile_v2.0_xx"
+        self.escalation_stats = {"lines": 0, "escalated": 0, "improved": 0}
+        # post-processing parameters, see `merge_sentence_boxes` and `merge_intersected_boxes`
+        self.merge_params = {"justify_ratio": 0.2, "gap_ratio": 2, "intersect_bias": 2}
+        self.idle_timeout = idle_timeout
+        self.model_options = model_options or {}
+        # Optional persistent cache of OCR results, see `configure_cache`
+        self.cache: Optional[DiskCache] = None
+        # PaddleOCR predictors are not thread-safe; serialize inference across report workers.
+        self.lock = threading.Lock()
+        self.registry_lock = threading.Lock()
         self.model_folder = Path(__file__).parent.resolve() / "ocr_models"
-        self.models = {
-            "chinese_cht_mobile_v2.0": PaddleOCR(
-                lang="chinese_cht",
-                det_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_det_infer"),
-                cls_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_cls_infer"),
-                rec_model_dir=str(self.model_folder / "chinese_cht_mobile_v2.0_rec_infer"),
-                use_gpu=False, total_process_num=os.cpu_count(), use_mp=True, show_log=False),
-            "ch_ppocr_mobile_v2.0_xx": PaddleOCR(
-                lang="ch",
-                det_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_det_infer"),
-                cls_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_cls_infer"),
-                rec_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_rec_infer"),
-                use_gpu=False, total_process_num=os.cpu_count(), use_mp=True, show_log=False),
-            "ch_PP-OCRv2_xx": PaddleOCR(
-                lang="ch",
-                det_model_dir=str(self.model_folder / "ch_PP-OCRv2_det_infer"),
-                cls_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_cls_infer"),
-                rec_model_dir=str(self.model_folder / "ch_PP-OCRv2_rec_infer"),
-                use_gpu=False, total_process_num=os.cpu_count(), use_mp=True, show_log=False),
-            "ch_ppocr_server_v2.0_xx": PaddleOCR(
-                lang="ch",
-                det_model_dir=str(self.model_folder / "ch_ppocr_server_v2.0_det_infer"),
-                cls_model_dir=str(self.model_folder / "ch_ppocr_mobile_v2.0_cls_infer"),
-                rec_model_dir=str(self.model_folder / "ch_ppocr_server_v2.0_rec_infer"),
-                use_gpu=False, total_process_num=os.cpu_count(), use_mp=True, show_log=False)
-        }
+        self.models = {}
+        self.last_used = {}
+        self.load_stats = {}
+        # Tiling of tall images, see `configure_tiling`; tile pipelines are per tile thread: {(thread, model): model}
+        self.tile_height: Optional[int] = None
+        self.tile_overlap = 200
+        self.tile_workers = 2
+        self.tile_pool: Optional[ThreadPoolExecutor] = None
+        self.tile_models = {}
+
+    def _load(self, ocr_model: str, extra_options: Optional[dict] = None):
+        # paddle is imported on first use so that importing this module stays cheap
+        from paddleocr import PaddleOCR
+        lang, det, cls, rec = OCR_MODEL_SPECS[ocr_model]
+        rss_before = current_rss_mb()
+        start_time = time.perf_counter()
+        options = dict(use_gpu=False, total_process_num=os.cpu_count(), use_mp=True, show_log=False)
+        options.update(self.model_options)
+        options.update(extra_options or {})
+        model = PaddleOCR(
+            lang=lang,
+            det_model_dir=str(self.model_folder / det),
+            cls_model_dir=str(self.model_folder / cls),
+            rec_model_dir=str(self.model_folder / rec),
+            **options)
+        load_time = time.perf_counter() - start_time
+        rss_after = current_rss_mb()
+        self.load_stats[ocr_model] = {"load_time": load_time, "rss_delta_mb": rss_after - rss_before}
+        logger.info(f"OCR model {ocr_model} loaded in {load_time:.2f}s (RSS {rss_before:.0f}MB -> {rss_after:.0f}MB)")
+        return model
 
     def get_model(self, ocr_model: str):
-        return self.models.get(ocr_model, self.models["ch_ppocr_server_v2.0_xx"])
+        if ocr_model not in OCR_MODEL_SPECS:
+            ocr_model = DEFAULT_OCR_MODEL
+        with self.registry_lock:
+            if ocr_model not in self.models:
+                self.models[ocr_model] = self._load(ocr_model)
+            self.last_used[ocr_model] = time.monotonic()
+            model = self.models[ocr_model]
+        if self.idle_timeout is not None:
+            self.unload_idle(self.idle_timeout)
+        return model
+
+    def unload(self, ocr_model: str):
+        with self.registry_lock:
+            for key in [key for key in self.tile_models if key[1] == ocr_model]:
+                del self.tile_models[key]
+            if self.models.pop(ocr_model, None) is not None:
+                self.last_used.pop(ocr_model, None)
+                gc.collect()
+                logger.info(f"OCR model {ocr_model} unloaded (RSS {current_rss_mb():.0f}MB)")
+
+    def unload_idle(self, max_idle: float):
+        """Unload the pipelines unused for more than `max_idle` seconds"""
+        now = time.monotonic()
+        for ocr_model, last_used in list(self.last_used.items()):
+            if now - last_used > max_idle:
+                self.unload(ocr_model)
+
+    def loaded_models(self) -> List[str]:
+        return list(self.models)
+
+    def configure_cache(self, path: Optional[str], max_bytes: Optional[int] = None, max_age: Optional[float] = None):
+        """
+        Persist OCR results keyed by image content: the raw Paddle boxes/scores per (image, model) and the final
+        strings per (image, model, threshold, merge parameters). Path None disables the cache.
+        """
+        if self.cache is not None:
+            self.cache.close()
+        self.cache = DiskCache(path, max_bytes, max_age) if path else None
+
+    def configure_tiling(self, tile_height: Optional[int], overlap: int = 200, workers: int = 2):
+        """
+        OCR images taller or wider than `tile_height` + `overlap` pixels as tiles of at most `tile_height` pixels
+        in each dimension, overlapping by `overlap` pixels (more than the tallest text line and the widest word),
+        on `workers` threads with a pipeline each. Tall captures are cut into full-width rows, wide (tablet,
+        landscape) screenshots into columns as well. None disables tiling.
+        """
+        if tile_height and not 0 <= overlap < tile_height:
+            raise ValueError(f"tile overlap {overlap} must be at least 0 and less than the tile height {tile_height}")
+        if self.tile_pool is not None:
+            self.tile_pool.shutdown()
+        self.tile_height = tile_height
+        self.tile_overlap = overlap
+        self.tile_workers = workers
+        self.tile_pool = ThreadPoolExecutor(workers, thread_name_prefix="ocr-tile") if tile_height else None
+        with self.registry_lock:
+            self.tile_models.clear()
+
+    def _bands(self, length: int) -> List[Tuple[int, int, float, float]]:
+        """
+        (start, end, owned start, owned end) of the bands tiling one dimension of this length. The owned parts
+        split the overlaps in the middle and cover the dimension exactly once.
+        """
+        if not self.tile_height or length <= self.tile_height + self.tile_overlap:
+            return [(0, length, 0, length)]
+        stride = self.tile_height - self.tile_overlap
+        count = -(-(length - self.tile_overlap) // stride)
+        bands = []
+        for k in range(count):
+            start, end = k * stride, min(k * stride + self.tile_height, length)
+            bands.append((start, end, 0 if k == 0 else start + self.tile_overlap / 2,
+                          length if k == count - 1 else end - self.tile_overlap / 2))
+        return bands
+
+    def tiles(self, height: int, width: int) -> List[Tuple[Tuple[int, int, float, float], ...]]:
+        """(row band, column band) of the tiles of an image of this size, row by row; see `_bands`"""
+        return [(rows, columns) for rows in self._bands(height) for columns in self._bands(width)]
+
+    def _tile_model(self, ocr_model: str):
+        """The tile thread's own pipeline, so that tiles are recognized in parallel"""
+        if ocr_model not in OCR_MODEL_SPECS:
+            ocr_model = DEFAULT_OCR_MODEL
+        key = (threading.get_ident(), ocr_model)
+        with self.registry_lock:
+            if key not in self.tile_models:
+                # the tile threads share the cores the pipeline would otherwise use alone
+                cores = self.model_options.get("cpu_threads", os.cpu_count() or 1)
+                threads = max(1, cores // self.tile_workers)
+                self.tile_models[key] = self._load(ocr_model, {"use_mp": False, "cpu_threads": threads})
+            return self.tile_models[key]
+
+    def _recognize_tile(self, pixels: np.ndarray, tile: tuple, ocr_model: str) -> list:
+        """Boxes of one tile in image coordinates, keeping those centered in the tile's owned area"""
+        (top, bottom, owned_top, owned_bottom), (left, right, owned_left, owned_right) = tile
+        result = self._tile_model(ocr_model).ocr(pixels[top:bottom, left:right], cls=False)[0]
+        boxes = []
+        for points, (text, score) in result or []:
+            points = [[float(x) + left, float(y) + top] for x, y in points]
+            center_y = (min(y for _, y in points) + max(y for _, y in points)) / 2
+            center_x = (min(x for x, _ in points) + max(x for x, _ in points)) / 2
+            if owned_top <= center_y < owned_bottom and owned_left <= center_x < owned_right:
+                boxes.append([points, [text, float(score)]])
+        return boxes
 
     def apply_threshold(self, result):
         return [item for item in result if item[1][1] >= self.threshold]
-    
-    def detect(self, img_path) -> List[str]:
-        img = cv2.imread(img_path)
-        img = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        model = self.get_model("ch_ppocr_mobile_v2.0_xx")
-        result = model.ocr(np.array(img), cls=False)[0]
-        result = self.apply_threshold(result)
-        texts = text_cvt_orc_format_paddle(result)
-        texts = merge_intersected_texts(texts)
-        texts = text_sentences_recognition(texts)
-        return [t.content for t in texts]
+
+    def recognize(self, img_path, ocr_model: str = "ch_ppocr_mobile_v2.0_xx") -> list:
+        """Raw Paddle result of an image: [[box points, (text, score)], ...]"""
+        if "+" in ocr_model:
+            return self.recognize_tiered(img_path, *ocr_model.split("+", 1))
+        with image_ingest.hold(img_path) as image, span("ocr.recognize", model=ocr_model) as s:
+            pixels = image.rgb()
+            tiles = self.tiles(*pixels.shape[:2])
+            s.tag(tiles=len(tiles))
+            if len(tiles) > 1:
+                # tiles are read in order, so that the boxes of full-width rows keep their top-down order
+                results = self.tile_pool.map(lambda tile: self._recognize_tile(pixels, tile, ocr_model), tiles)
+                boxes = [box for boxes in results for box in boxes]
+                if any(columns[0] > 0 for _, columns in tiles):
+                    # boxes of side-by-side tiles are put back in reading order, as Paddle orders a whole image
+                    boxes.sort(key=lambda box: (box[0][0][1], box[0][0][0]))
+                return boxes
+            model = self.get_model(ocr_model)
+            with self.lock:
+                result = model.ocr(pixels, cls=False)[0]
+        return [[[[float(x), float(y)] for x, y in points], [text, float(score)]]
+                for points, (text, score) in result or []]
+
+    def recognize_tiered(self, img_path, fast_model: str, accurate_model: str) -> list:
+        """
+        Detect and recognize with `fast_model`, then re-recognize the lines scoring below the threshold with
+        the recognizer of `accurate_model` (on the detected crops, without detection); a line takes the
+        accurate reading when it scores higher
+        """
+        result = self.recognize(img_path, fast_model)
+        unsure = [i for i, (_, (_, score)) in enumerate(result) if score < self.threshold]
+        if unsure:
+            with span("ocr.escalate", model=accurate_model, lines=len(result), escalated=len(unsure)):
+                model = self.get_model(accurate_model)
+                with image_ingest.hold(img_path) as image:
+                    pixels = image.rgb()
+                    crops = [crop_text_region(pixels, result[i][0]) for i in unsure]
+                kept = [(i, crop) for i, crop in zip(unsure, crops) if crop.size]
+                with self.lock:
+                    readings = model.ocr([[crop for _, crop in kept]], det=False, cls=False)[0] if kept else []
+                for (i, _), (text, score) in zip(kept, readings or []):
+                    if float(score) > result[i][1][1]:
+                        result[i][1] = [text, float(score)]
+                        with self.lock:
+                            self.escalation_stats["improved"] += 1
+        with self.lock:
+            self.escalation_stats["lines"] += len(result)
+            self.escalation_stats["escalated"] += len(unsure)
+        return result
+
+    def postprocess(self, result) -> List[str]:
+        with span("ocr.postprocess", boxes=len(result)):
+            boxes = TextBoxes.from_paddle(self.apply_threshold(result))
+            boxes = merge_intersected_boxes(boxes, self.merge_params["intersect_bias"])
+            boxes = merge_sentence_boxes(boxes, self.merge_params["justify_ratio"], self.merge_params["gap_ratio"])
+            return boxes.contents
+
+    def cache_keys(self, img_hash: str, ocr_model: str):
+        """Cache keys of the raw result and of the final strings of an image"""
+        # which lines a tiered pipeline escalates depends on the threshold
+        pipeline = f"{ocr_model}@{self.threshold}" if "+" in ocr_model else ocr_model
+        if self.tile_height:
+            pipeline = f"{pipeline}/tiles:{self.tile_height}x{self.tile_height}-{self.tile_overlap}"
+        return (content_key("raw", img_hash, pipeline),
+                content_key("texts", img_hash, pipeline, self.threshold, self.merge_params))
+
+    def detect(self, img_path, ocr_model: Optional[str] = None) -> List[str]:
+        ocr_model = ocr_model or self.ocr_model
+        with span("ocr.detect", model=ocr_model) as s:
+            if self.cache is None:
+                return self.postprocess(self.recognize(img_path, ocr_model))
+            raw_key, final_key = self.cache_keys(image_ingest.digest(img_path), ocr_model)
+            texts = self.cache.get(final_key)
+            if texts is not None:
+                s.tag(cache_hit="texts")
+                return texts
+            result = self.cache.get(raw_key)
+            if result is None:
+                s.tag(cache_hit=False)
+                result = self.recognize(img_path, ocr_model)
+                self.cache.put(raw_key, result)
+            else:
+                s.tag(cache_hit="raw")
+            texts = self.postprocess(result)
+            self.cache.put(final_key, texts)
+            return texts
 
 ocr_detector = OCRDetector()
 
 
 @timeit
+@share_stage
 def ocr_detect(img_path: str):
     result = []
     inter_result = ocr_detector.detect(img_path)
     for text in inter_result:
        result.extend(re.split(r"\s+", text))
-    print(result)
+    logger.debug(f"OCR result: {result}")
     return result
\ No newline at end of file
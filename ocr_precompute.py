@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+from cache import sha256_file
+from logger import logger
+from ocr_detect import OCRDetector, OCR_MODEL_SPECS, TIERED_OCR_MODEL
+from utils import dataset_base
+
+_worker_detector: Optional[OCRDetector] = None
+
+
+def _init_worker(model_options: dict, tiling: Optional[Tuple[int, int, int]]):
+    global _worker_detector
+    _worker_detector = OCRDetector(model_options=model_options)
+    if tiling is not None:
+        _worker_detector.configure_tiling(*tiling)
+
+
+def _recognize(img_path: str, ocr_model: str) -> Tuple[str, list, List[str]]:
+    result = _worker_detector.recognize(img_path, ocr_model)
+    return img_path, result, _worker_detector.postprocess(result)
+
+
+def precompute(image_paths: List[str], cache_path: str, workers: int, ocr_model: str = "ch_ppocr_mobile_v2.0_xx",
+               rec_batch_num: int = 16, force: bool = False, tiling: Optional[Tuple[int, int, int]] = None):
+    """
+    OCR all images ahead of time with a pool of Paddle worker processes and store the results in the OCR cache,
+    which `ocr_detect` then reads instead of running OCR in the report loop.
+    :param tiling: (tile height, overlap, tile threads) of tall images, as `OCRDetector.configure_tiling`
+    """
+    detector = OCRDetector()
+    if tiling is not None:
+        # only for the cache keys; the tiles are recognized in the workers
+        detector.tile_height, detector.tile_overlap = tiling[:2]
+    detector.configure_cache(cache_path)
+    todo = []
+    for img_path in image_paths:
+        _, final_key = detector.cache_keys(sha256_file(img_path), ocr_model)
+        if force or detector.cache.get(final_key) is None:
+            todo.append(img_path)
+    logger.info(f"OCR precompute: {len(image_paths) - len(todo)} images cached, {len(todo)} to process")
+    if not todo:
+        return
+
+    # one single-process Paddle pipeline per worker, with the cores split between workers
+    model_options = {"use_mp": False, "total_process_num": 1,
+                     "cpu_threads": max(1, (os.cpu_count() or 1) // workers), "rec_batch_num": rec_batch_num}
+    start_time = time.perf_counter()
+    done, failed = 0, 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_options, tiling)) as pool:
+        futures = [pool.submit(_recognize, img_path, ocr_model) for img_path in todo]
+        for future in as_completed(futures):
+            try:
+                img_path, result, texts = future.result()
+            except Exception as e:
+                failed += 1
+                logger.warning(f"OCR precompute failed -- {e}")
+                continue
+            raw_key, final_key = detector.cache_keys(sha256_file(img_path), ocr_model)
+            detector.cache.put(raw_key, result)
+            detector.cache.put(final_key, texts)
+            done += 1
+            elapsed = time.perf_counter() - start_time
+            print(f"\r{done + failed}/{len(todo)} images, {done / elapsed:.2f} img/s", end="", file=sys.stderr)
+    print(file=sys.stderr)
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"OCR precompute: {done} images in {elapsed:.1f}s ({done / elapsed:.2f} img/s, {workers} workers), "
+                f"{failed} failed")
+    detector.cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCR the dataset images ahead of time")
+    parser.add_argument("--images", default=str(dataset_base / "images"), help="folder of the screenshots")
+    parser.add_argument("--cache", default="ocr_cache.sqlite", help="OCR cache read by main.py --ocr-cache")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of OCR worker processes")
+    parser.add_argument("--rec-batch-num", type=int, default=16, help="text lines recognized per batch")
+    parser.add_argument("--force", action="store_true", help="recompute images that are already cached")
+    parser.add_argument("--tile-height", type=int, default=None, help="OCR taller images as overlapping tiles")
+    parser.add_argument("--tile-overlap", type=int, default=200, help="overlap of OCR tiles in pixels")
+    parser.add_argument("--tile-workers", type=int, default=1, help="tiles recognized in parallel per worker")
+    parser.add_argument("--ocr-model", default="ch_ppocr_mobile_v2.0_xx",
+                        choices=list(OCR_MODEL_SPECS) + [TIERED_OCR_MODEL], help="OCR pipeline to cache results of")
+    args = parser.parse_args()
+    paths = sorted(entry.path for entry in os.scandir(args.images) if entry.name.endswith(".jpg"))
+    tiling = (args.tile_height, args.tile_overlap, args.tile_workers) if args.tile_height else None
+    precompute(paths, args.cache, args.workers, args.ocr_model, rec_batch_num=args.rec_batch_num, force=args.force,
+               tiling=tiling)
@@ -1,84 +1,249 @@
+import argparse
+import json
+import os
 import re
-import sys
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
 
 from utils import get_labels_true
 
-def logic_chain_triggering_analysis(log_file: str):
-    result = {}
-    with open(log_file, mode="r", encoding="utf-8") as f:
-        pattern1 = r'\{(["\'])result(["\']):\s*(True|False),\s*(["\'])reason(["\']):\s*(["\'])(.*?)(["\'])\}'
-        pattern2 = "Report #(\d+) Consistent?"
-        temp = []
-        for line in f.readlines():
-            match1 = re.search(pattern1, line)
-            match2 = re.search(pattern2, line)
-            if "WARNING" in line:
-                temp.clear()
-            if match1:
-                temp.append(match1.group(3) == "True")
-            elif match2:
-                key = "-".join(str(e) for e in temp)
-                if key not in result.keys():
-                    result[key] = 1
-                else:
-                    result[key] += 1
-                temp.clear()
-    total = sum(v for v in result.values())
-    for k, v in result.items():
-        print(k, v, v / total)
+# the reason is absent in verdict-only mode
+RESULT_PATTERN = re.compile(r'\{(["\'])result(["\']):\s*(True|False)(,\s*(["\'])reason(["\']):\s*(["\'])(.*?)(["\']))?\}')
+VERDICT_PATTERN = re.compile(r"(?:\[([^\]]+)\] )?Report #(\d+) Consistent?")
+COST_PATTERN = re.compile(r"Input token: (\d+) \(\$(\d+\.\d+)\); Output token: (\d+) \(\$(\d+\.\d+)\)")
+# the run id field of a human-readable line ("-" outside any run)
+LINE_RUN_PATTERN = re.compile(r"^\S+ \S+ - [A-Z]+ - \S+ - run (\S+) - ")
+# lines opening a run in logs written before lines carried their run id (main.py, distributed.py)
+RUN_PATTERN = re.compile(r"(?:Run (\S+) started|Resuming run (\S+):|Worker \S+ joined run (\S+) )")
+METRICS = ["accuracy", "precision", "recall", "f1"]
+
+
+class RunStats:
+    """Everything the analysis needs from the log lines of one run; its size depends on reports, not lines"""
+
+    def __init__(self):
+        self.reports = 0
+        self.input_tokens, self.output_tokens = 0, 0
+        self.input_money, self.output_money = 0.0, 0.0
+        self.money = 0.0
+        # per variant tag: verdict lines and the (tokens, money) logged since the previous verdict line, shared
+        # stages included; the totals above are what the run paid
+        self.variant_lines = Counter()
+        self.variant_tokens = Counter()
+        self.variant_money: Dict[Optional[str], float] = {}
+        self.pending_tokens, self.pending_money = 0, 0.0
+        # verdicts per variant tag (None: untagged lines), and of any line, the last one of a report winning
+        self.verdicts: Dict[Optional[str], Dict[str, bool]] = {}
+        self.any_verdicts: Dict[str, bool] = {}
+        self.chains = Counter()
+        self.chain = []
+
+    def feed(self, message: str, warning: bool):
+        if warning:
+            self.chain.clear()
+            if "Analysis for Report" in message:
+                # a failed analysis: its spend stays in the run totals, but belongs to no variant's verdicts
+                self.pending_tokens, self.pending_money = 0, 0.0
+        # "[cached]" lines were answered from the response cache: nothing was spent
+        if "Input token" in message and "[cached]" not in message:
+            match = COST_PATTERN.search(message)
+            if match:
+                self.pending_tokens += int(match.group(1)) + int(match.group(3))
+                self.pending_money += float(match.group(2)) + float(match.group(4))
+                # "[shared]" lines repeat a stage an ablation variant reused: part of what the variant costs,
+                # but not paid again by the run
+                if "[shared]" not in message:
+                    self.input_tokens += int(match.group(1))
+                    self.input_money += float(match.group(2))
+                    self.output_tokens += int(match.group(3))
+                    self.output_money += float(match.group(4))
+                    self.money += float(match.group(2)) + float(match.group(4))
+        if "result" in message:
+            match = RESULT_PATTERN.search(message)
+            if match:
+                self.chain.append(match.group(3) == "True")
+                return
+        if "Consistent?" in message:
+            match = VERDICT_PATTERN.search(message)
+            if match:
+                variant, report_id = match.group(1), match.group(2)
+                consistent = message.strip().endswith("True")
+                self.verdicts.setdefault(variant, {})[report_id] = consistent
+                self.any_verdicts[report_id] = consistent
+                self.reports += 1
+                self.variant_lines[variant] += 1
+                self.variant_tokens[variant] += self.pending_tokens
+                self.variant_money[variant] = self.variant_money.get(variant, 0.0) + self.pending_money
+                self.pending_tokens, self.pending_money = 0, 0.0
+                self.chains["-".join(str(e) for e in self.chain)] += 1
+                self.chain.clear()
+
 
-def classification_analysis(log_file: str):
-    true_dict = get_labels_true()
-    pred_dict = {}
+def _iter_messages(log_file: str) -> Iterable[Tuple[Optional[str], str, bool]]:
+    """
+    (run id, message, is warning) of every line of a human-readable or JSON-lines log, streamed.
+    Lines carry their run id, so runs appending to the same log at the same time are told apart; in older
+    logs, a line belongs to the last run opened before it.
+    """
+    run_id = None
     with open(log_file, mode="r", encoding="utf-8") as f:
-        pattern = "Report #(\d+) Consistent?"
-        for line in f.readlines():
-            match = re.search(pattern, line)
+        for line in f:
+            if line.startswith('{"time"'):
+                record = json.loads(line)
+                yield record.get("run_id"), record["message"], record["level"] == "WARNING"
+                continue
+            match = LINE_RUN_PATTERN.match(line)
             if match:
-                report_id = match.group(1)
-                consistent = True if line.strip().endswith("True") else False
-                pred_dict[report_id] = consistent
-    tp, tn, fp, fn = 0, 0, 0, 0
-    for k, v in pred_dict.items():
-        pred, true = v, true_dict[k]
-        if pred and true:
-            tp += 1
-        elif not pred and not true:
-            tn += 1
-        elif pred and not true:
-            fp += 1
-        elif not pred and true:
-            fn += 1
+                yield (match.group(1) if match.group(1) != "-" else None), line, "WARNING" in line
+                continue
+            if " started" in line or "run " in line:
+                match = RUN_PATTERN.search(line)
+                if match:
+                    run_id = next(g for g in match.groups() if g)
+            yield run_id, line, "WARNING" in line
+
+
+def analyze_logs(log_files: List[str], by_run: bool = True) -> Dict[str, RunStats]:
+    """
+    Read each log once and gather the statistics of every run in it.
+    Runs are told apart by the run id of each line (in logs written before lines carried it, by the last
+    "Run <id> started" line); lines outside any run belong to run "-". With several files, runs are named
+    `<file>:<run id>`; with `by_run` False, each file is one run.
+    """
+    runs: Dict[str, RunStats] = {}
+    for log_file in log_files:
+        prefix = f"{os.path.basename(log_file)}:" if len(log_files) > 1 else ""
+        for run_id, message, warning in _iter_messages(log_file):
+            key = prefix + (run_id or "-") if by_run else (prefix.rstrip(":") or "-")
+            stats = runs.get(key)
+            if stats is None:
+                stats = runs[key] = RunStats()
+            stats.feed(message, warning)
+    return runs
+
+
+def confusion(pred: Dict[str, bool], labels: Dict[str, bool]) -> np.ndarray:
+    """(tp, tn, fp, fn) of the predictions"""
+    keys = list(pred)
+    p = np.fromiter((pred[k] for k in keys), dtype=bool, count=len(keys))
+    t = np.fromiter((labels[k] for k in keys), dtype=bool, count=len(keys))
+    return np.array([np.sum(p & t), np.sum(~p & ~t), np.sum(p & ~t), np.sum(~p & t)])
+
+
+def metrics(counts: np.ndarray) -> Dict[str, np.ndarray]:
+    """Metrics of one (4,) or many (..., 4) confusion counts; undefined ratios are nan"""
+    counts = np.asarray(counts, dtype=float)
+    tp, tn, fp, fn = np.moveaxis(counts, -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {"accuracy": (tp + tn) / (tp + tn + fp + fn), "precision": tp / (tp + fp),
+                "recall": tp / (tp + fn), "f1": 2 * tp / (2 * tp + fp + fn)}
+
+
+def bootstrap(counts: np.ndarray, samples: int = 2000, confidence: float = 0.95,
+              seed: int = 0) -> Dict[str, Tuple[float, float]]:
+    """
+    Percentile bootstrap intervals of the metrics. Resampling the reports with replacement only changes how many
+    fall in each confusion cell, so all samples are drawn at once as multinomial counts, in O(samples) memory.
+    """
+    n = int(counts.sum())
+    if n == 0:
+        return {name: (float("nan"), float("nan")) for name in METRICS}
+    draws = np.random.default_rng(seed).multinomial(n, counts / n, size=samples)
+    alpha = (1 - confidence) / 2 * 100
+    intervals = {}
+    for name, values in metrics(draws).items():
+        values = values[~np.isnan(values)]
+        intervals[name] = (tuple(float(x) for x in np.percentile(values, [alpha, 100 - alpha])) if len(values)
+                           else (float("nan"), float("nan")))
+    return intervals
+
+
+def compare_runs(runs: Dict[str, RunStats], labels: Dict[str, bool], variant: Optional[str] = None,
+                 samples: int = 2000, confidence: float = 0.95) -> List[dict]:
+    """One row per run and variant: confusion counts, metrics with bootstrap intervals and average cost"""
+    rows = []
+    for name, stats in runs.items():
+        variants = [variant] if variant is not None else sorted(stats.verdicts, key=lambda v: v or "")
+        for v in variants:
+            pred = stats.verdicts.get(v)
+            if not pred:
+                continue
+            counts = confusion(pred, labels)
+            # what the variant costs on its own: the stages logged in its report blocks, shared ones included
+            lines = max(stats.variant_lines[v], 1)
+            row = {"run": name, "variant": v or "-", "reports": int(counts.sum()),
+                   **dict(zip(["tp", "tn", "fp", "fn"], counts.tolist())),
+                   "avg_money": stats.variant_money.get(v, 0.0) / lines,
+                   "avg_tokens": stats.variant_tokens[v] / lines}
+            point = metrics(counts)
+            for metric, interval in bootstrap(counts, samples, confidence).items():
+                row[metric] = (float(point[metric]), *interval)
+            rows.append(row)
+    return rows
+
+
+def format_comparison(rows: List[dict]) -> str:
+    header = f"{'run':<32} {'variant':<30} {'reports':>7}" + "".join(f" {m:>20}" for m in METRICS) + \
+             f" {'$/report':>10} {'tokens':>8}"
+    lines = [header]
+    for row in rows:
+        cells = "".join(f" {row[m][0]:.3f} [{row[m][1]:.3f}, {row[m][2]:.3f}]" for m in METRICS)
+        lines.append(f"{row['run']:<32} {row['variant']:<30} {row['reports']:>7}{cells}"
+                     f" {row['avg_money']:>10.6f} {row['avg_tokens']:>8.1f}")
+    return "\n".join(lines)
+
+
+def _single_run(log_file: str) -> RunStats:
+    return analyze_logs([log_file], by_run=False)["-"]
+
+
+def logic_chain_triggering_analysis(log_file: str):
+    chains = _single_run(log_file).chains
+    total = sum(chains.values())
+    for k, v in chains.items():
+        print(k, v, v / total)
+
+
+def classification_analysis(log_file: str, variant: Optional[str] = None):
+    stats = _single_run(log_file)
+    pred_dict = stats.any_verdicts if variant is None else stats.verdicts.get(variant, {})
+    tp, tn, fp, fn = confusion(pred_dict, get_labels_true()).tolist()
     print(f"tp = {tp}\ntn = {tn}\nfp = {fp}\nfn = {fn}\ntotal = {tp + tn + fp + fn}")
-    print(f"accuracy = {(tp + tn) / (tp + tn + fp + fn)}")
-    print(f"precision = {tp / (tp + fp)}")
-    print(f"recall = {tp / (tp + fn)}")
-    print(f"f1-score = {2 * tp / (2 * tp + fp + fn)}")
+    for name, value in metrics(np.array([tp, tn, fp, fn])).items():
+        print(f"{name if name != 'f1' else 'f1-score'} = {value}")
+
 
 def cost_analysis(log_file: str):
-    total = 0
-    money_usage, token_usage = [], []
-    with open(log_file, mode="r", encoding="utf-8") as f:
-        pattern1 = r"Input token: (\d+) \(\$(\d+\.\d+)\); Output token: (\d+) \(\$(\d+\.\d+)\)"
-        pattern2 = "Report #(\d+) Consistent?"
-        for line in f.readlines():
-            match1 = re.search(pattern1, line)
-            match2 = re.search(pattern2, line)
-            if match1:
-                input_token = int(match1.group(1))
-                input_price = float(match1.group(2))
-                output_token = int(match1.group(3))
-                output_price = float(match1.group(4))
-                money_usage.append(input_price + output_price)
-                token_usage.append(input_token + output_token)
-            if match2:
-                total += 1
-    print(f"avg money cost: {sum(money_usage) / total}")
-    print(f"avg token cost: {sum(token_usage) / total}")
+    stats = _single_run(log_file)
+    total = stats.reports
+    print(f"avg money cost: {stats.money / total}")
+    print(f"avg token cost: {(stats.input_tokens + stats.output_tokens) / total}")
+    # output tokens are the expensive side; verdict-only runs shrink this part
+    print(f"avg input token: {stats.input_tokens / total} (${stats.input_money / total:.6f})")
+    print(f"avg output token: {stats.output_tokens / total} (${stats.output_money / total:.6f})")
 
 
 if __name__ == "__main__":
-    log_file_path = sys.argv[1]
-    cost_analysis(log_file_path)
-    classification_analysis(log_file_path)
-    logic_chain_triggering_analysis(log_file_path)
+    parser = argparse.ArgumentParser(description="Metrics of one or several runs, read from their logs in one pass")
+    parser.add_argument("logs", nargs="+", help="human-readable or JSON-lines logs; a trailing non-file argument "
+                                                "is taken as --variant")
+    parser.add_argument("--variant", default=None, help="only the verdicts logged as [<variant>] Report #N")
+    parser.add_argument("--merge-runs", action="store_true", help="treat each log file as a single run")
+    parser.add_argument("--bootstrap", type=int, default=2000, help="bootstrap samples of the intervals")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals")
+    parser.add_argument("--chains", action="store_true", help="also print the stage outcome chains of each run")
+    args = parser.parse_args()
+    if len(args.logs) > 1 and not os.path.exists(args.logs[-1]) and args.variant is None:
+        # `result_analysis.py <log_file> <variant>`
+        args.variant = args.logs.pop()
+
+    runs = analyze_logs(args.logs, by_run=not args.merge_runs)
+    print(format_comparison(compare_runs(runs, get_labels_true(), args.variant, args.bootstrap, args.confidence)))
+    if args.chains:
+        for name, stats in runs.items():
+            total = sum(stats.chains.values())
+            print(f"\n{name}")
+            for k, v in stats.chains.most_common():
+                print(k, v, v / total)
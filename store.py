@@ -0,0 +1,195 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from logger import logger
+
+
+class ResultStore:
+    """
+    Durable per-report results of pipeline runs, keyed by (run id, report index).
+    Each finished report is committed immediately, so an interrupted run can be resumed.
+    """
+
+    def __init__(self, path: str = "results.sqlite", timeout: float = 30.0):
+        self.path = path
+        self.lock = threading.Lock()
+        # several processes may write the same file; a writer waits up to `timeout` for the others
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS reports (
+                run_id TEXT NOT NULL,
+                report_index INTEGER NOT NULL,
+                verdict INTEGER NOT NULL,
+                stages TEXT NOT NULL,
+                finished_at REAL NOT NULL,
+                PRIMARY KEY (run_id, report_index)
+            )""")
+        self.conn.commit()
+
+    def save(self, run_id: str, report_index: int, verdict: bool, stages: List[Tuple[str, Any]]):
+        """Record the final verdict of a report and the outcome of each stage it went through"""
+        with self.lock:
+            self._insert(run_id, report_index, verdict, stages)
+            self.conn.commit()
+
+    def save_run(self, run_id: str, results: Dict[int, Dict[str, Any]]):
+        """Record many results of a run (in the format returned by `load`) in one transaction"""
+        with self.lock:
+            for report_index, result in results.items():
+                self._insert(run_id, report_index, result["verdict"], result["stages"])
+            self.conn.commit()
+
+    def _insert(self, run_id: str, report_index: int, verdict: bool, stages: List[Tuple[str, Any]]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?)",
+            (run_id, int(report_index), int(bool(verdict)), json.dumps(stages, ensure_ascii=False), time.time())
+        )
+
+    def finished(self, run_id: str) -> Set[int]:
+        """Indices of the reports already analyzed in the run"""
+        with self.lock:
+            rows = self.conn.execute("SELECT report_index FROM reports WHERE run_id = ?", (run_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def load(self, run_id: str) -> Dict[int, Dict[str, Any]]:
+        """All results of the run: {report index: {"verdict": bool, "stages": [[stage, outcome], ...]}}"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT report_index, verdict, stages FROM reports WHERE run_id = ? ORDER BY report_index", (run_id,)
+            ).fetchall()
+        return {idx: {"verdict": bool(verdict), "stages": json.loads(stages)} for idx, verdict, stages in rows}
+
+    def runs(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT run_id FROM reports ORDER BY run_id")]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+
+class WorkQueue(ResultStore):
+    """
+    Reports of a run shared out to worker processes (on one or several hosts) through leases.
+    A worker leases a few pending report indices, renews its leases by heartbeat while it works on them, and
+    commits the results of a report together with marking it done. A lease that is not renewed expires, and
+    its report goes to the next worker asking for work. Results land in the `reports` table of the same file,
+    so the queue is also the result store of the run.
+    """
+
+    def __init__(self, path: str = "queue.sqlite", timeout: float = 30.0):
+        super().__init__(path, timeout)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                run_id TEXT NOT NULL,
+                report_index INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                expires_at REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (run_id, report_index)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS lease_status ON leases (run_id, status, expires_at)")
+        self.conn.commit()
+
+    def populate(self, run_id: str, indices: Iterable[int]) -> int:
+        """Queue the reports of a run; reports already queued keep their state, so every worker may call this"""
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO leases (run_id, report_index, status) VALUES (?, ?, 'pending')",
+                ((run_id, int(idx)) for idx in indices))
+            self.conn.commit()
+            return self.conn.total_changes - before
+
+    def lease(self, run_id: str, worker: str, count: int, ttl: float, max_attempts: int = 3) -> List[int]:
+        """
+        Lease up to `count` pending reports, or reports whose lease expired, for `ttl` seconds.
+        An expired report that already used up `max_attempts` (its workers kept dying on it) is marked failed.
+        """
+        now = time.time()
+        with self.lock:
+            # an immediate transaction keeps two workers from leasing the same report
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                failed = self.conn.execute(
+                    "UPDATE leases SET status = 'failed', worker = NULL, expires_at = 0 WHERE run_id = ? AND "
+                    "status = 'leased' AND expires_at < ? AND attempts >= ?", (run_id, now, max_attempts)).rowcount
+                rows = self.conn.execute(
+                    "SELECT report_index, status FROM leases WHERE run_id = ? AND "
+                    "(status = 'pending' OR (status = 'leased' AND expires_at < ?)) ORDER BY report_index LIMIT ?",
+                    (run_id, now, count)
+                ).fetchall()
+                self.conn.executemany(
+                    "UPDATE leases SET status = 'leased', worker = ?, expires_at = ?, attempts = attempts + 1 "
+                    "WHERE run_id = ? AND report_index = ?", ((worker, now + ttl, run_id, idx) for idx, _ in rows))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        if failed:
+            logger.warning(f"{failed} reports of run {run_id} failed: their leases expired {max_attempts} times")
+        reclaimed = sum(status == "leased" for _, status in rows)
+        if reclaimed:
+            logger.warning(f"Worker {worker} reclaimed {reclaimed} expired leases")
+        return [idx for idx, _ in rows]
+
+    def heartbeat(self, run_id: str, worker: str, indices: Iterable[int], ttl: float) -> Set[int]:
+        """Renew the worker's leases; returns the indices it no longer holds (expired and leased by another)"""
+        indices = set(indices)
+        if not indices:
+            return set()
+        expires_at = time.time() + ttl
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE leases SET expires_at = ? WHERE run_id = ? AND report_index = ? AND worker = ? "
+                "AND status = 'leased'", ((expires_at, run_id, idx, worker) for idx in indices))
+            self.conn.commit()
+            held = {row[0] for row in self.conn.execute(
+                "SELECT report_index FROM leases WHERE run_id = ? AND worker = ? AND status = 'leased'",
+                (run_id, worker))}
+        return indices - held
+
+    def complete(self, run_id: str, worker: str, report_index: int,
+                 results: Dict[str, Tuple[bool, List[Tuple[str, Any]]]]) -> bool:
+        """
+        Commit the results of a report, {result run id: (verdict, stages)}, and mark it done, atomically.
+        The results are kept either way, but only the worker holding the lease marks the report done; returns
+        whether it still held it.
+        """
+        with self.lock:
+            try:
+                for result_run_id, (verdict, stages) in results.items():
+                    self._insert(result_run_id, report_index, verdict, stages)
+                held = self.conn.execute(
+                    "UPDATE leases SET status = 'done', expires_at = ? WHERE run_id = ? AND report_index = ? "
+                    "AND worker = ? AND status = 'leased'", (time.time(), run_id, int(report_index), worker)).rowcount
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return held > 0
+
+    def release(self, run_id: str, worker: str, report_index: int, max_attempts: int):
+        """
+        Give a report back after a failed analysis; it is marked failed once it used up its attempts.
+        A worker whose lease expired and was reclaimed leaves the new holder's lease alone.
+        """
+        with self.lock:
+            self.conn.execute(
+                "UPDATE leases SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+                "expires_at = 0 WHERE run_id = ? AND report_index = ? AND worker = ? AND status = 'leased'",
+                (max_attempts, run_id, int(report_index), worker))
+            self.conn.commit()
+
+    def status(self, run_id: str) -> Dict[str, int]:
+        """Number of reports of the run per state: pending, leased, done, failed"""
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM leases WHERE run_id = ? GROUP BY status",
+                                     (run_id,)).fetchall()
+        return {"pending": 0, "leased": 0, "done": 0, "failed": 0, **dict(rows)}
@@ -0,0 +1,164 @@
+"""
+Greedy text merging backed by spatial indexes.
+
+Both merging passes keep the exact semantics of the original all-pairs scan: every text is merged into the
+*first* kept text (in keep order) it can merge with, and passes repeat until nothing changes. The indexes only
+skip kept texts that cannot satisfy the merge condition, so the merged texts and their order are unchanged,
+while a pass costs about O(n * k) instead of O(n^2) for k nearby candidates. The boxes live in a `TextBoxes`
+table and each text is tested against all its candidates in one vectorized step.
+"""
+
+import math
+from collections import defaultdict
+from typing import Callable, Dict, List, Set, Tuple
+
+import numpy as np
+
+from utils import Text, TextBoxes
+
+# Candidate lists longer than this are tested in one vectorized step, shorter ones pair by pair
+VECTORIZE_ABOVE = 16
+
+
+class GridIndex:
+    """Uniform grid over text boxes; `candidates` returns every kept text whose box overlaps the query box"""
+
+    def __init__(self, cell: float, pad: float = 0):
+        self.cell = cell
+        self.pad = pad
+        self.cells: Dict[Tuple[int, int], Set[int]] = defaultdict(set)
+        self.entries: Dict[int, List[Tuple[int, int]]] = {}
+
+    def _cells(self, box: Tuple, pad: float = 0) -> List[Tuple[int, int]]:
+        left, top, right, bottom = box
+        x0 = math.floor((left - pad) / self.cell)
+        x1 = math.floor((right + pad) / self.cell)
+        y0 = math.floor((top - pad) / self.cell)
+        y1 = math.floor((bottom + pad) / self.cell)
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def add(self, pos: int, box: Tuple):
+        cells = self._cells(box)
+        self.entries[pos] = cells
+        for c in cells:
+            self.cells[c].add(pos)
+
+    def remove(self, pos: int):
+        for c in self.entries.pop(pos):
+            self.cells[c].discard(pos)
+
+    def candidates(self, box: Tuple) -> Set[int]:
+        found = set()
+        for c in self._cells(box, self.pad):
+            found.update(self.cells.get(c, ()))
+        return found
+
+
+class RowIndex:
+    """Buckets of kept texts by their top edge; `candidates` returns texts whose top is within `ratio` * height"""
+
+    def __init__(self, bucket: float, ratio: float):
+        self.bucket = bucket
+        self.ratio = ratio
+        self.buckets: Dict[int, Set[int]] = defaultdict(set)
+        self.entries: Dict[int, int] = {}
+
+    def add(self, pos: int, box: Tuple):
+        key = math.floor(box[1] / self.bucket)
+        self.entries[pos] = key
+        self.buckets[key].add(pos)
+
+    def remove(self, pos: int):
+        self.buckets[self.entries.pop(pos)].discard(pos)
+
+    def candidates(self, box: Tuple) -> Set[int]:
+        top, bottom = box[1], box[3]
+        reach = self.ratio * (bottom - top)
+        if reach <= 0:
+            # the justification bias is ratio * min(heights), so nothing can be justified with this text
+            return set()
+        found = set()
+        for key in range(math.floor((top - reach) / self.bucket), math.floor((top + reach) / self.bucket) + 1):
+            found.update(self.buckets.get(key, ()))
+        return found
+
+
+def merge_pass(boxes: TextBoxes, rows: List[int], index, mergeable: Callable[[int, np.ndarray], np.ndarray],
+               mergeable_pair: Callable[[int, int], bool]) -> Tuple[List[int], bool]:
+    """
+    One greedy pass over `rows`: each row merges into the first kept row it can merge with, or is kept itself.
+    `mergeable(row, kept_rows)` is the mask of the kept rows `row` can merge with, `mergeable_pair(row, kept_row)`
+    the same test for one pair, used for short candidate lists where array overhead dominates.
+    """
+    kept = []
+    changed = False
+    for row in rows:
+        box = boxes.box(row)
+        positions = sorted(index.candidates(box))
+        if len(positions) > VECTORIZE_ABOVE:
+            hits = np.flatnonzero(mergeable(row, np.array([kept[p] for p in positions], dtype=np.int64)))
+            pos = positions[hits[0]] if len(hits) else None
+        else:
+            pos = next((p for p in positions if mergeable_pair(row, kept[p])), None)
+        if pos is not None:
+            index.remove(pos)
+            boxes.merge(kept[pos], row)
+            index.add(pos, boxes.box(kept[pos]))
+            changed = True
+            continue
+        index.add(len(kept), box)
+        kept.append(row)
+    return kept, changed
+
+
+def _typical_size(boxes: TextBoxes, rows: List[int]) -> float:
+    if not rows:
+        return 1.0
+    sizes = np.maximum(boxes.width[rows], boxes.height[rows])
+    return max(float(np.median(sizes)), 1.0)
+
+
+def _sentence_rows(boxes: TextBoxes, justify_ratio: float, gap_ratio: float) -> List[int]:
+    def mergeable(row, kept_rows):
+        return boxes.same_line_mask(justify_ratio, gap_ratio, row, kept_rows)
+
+    rows, changed = list(range(len(boxes))), True
+    while changed:
+        bucket = max(abs(justify_ratio) * _typical_size(boxes, rows), 1.0)
+        rows, changed = merge_pass(boxes, rows, RowIndex(bucket, justify_ratio), mergeable,
+                                   lambda row, kept_row: boxes.on_same_line(row, kept_row, justify_ratio, gap_ratio))
+    return rows
+
+
+def _intersected_rows(boxes: TextBoxes, bias: float) -> List[int]:
+    def mergeable(row, kept_rows):
+        return boxes.intersection_mask(bias, row, kept_rows)
+
+    rows, changed = list(range(len(boxes))), True
+    while changed:
+        index = GridIndex(2 * _typical_size(boxes, rows), max(0, -bias))
+        rows, changed = merge_pass(boxes, rows, index, mergeable,
+                                   lambda row, kept_row: boxes.intersects(row, kept_row, bias))
+    return rows
+
+
+def merge_sentence_boxes(boxes: TextBoxes, justify_ratio: float = 0.2, gap_ratio: float = 2) -> TextBoxes:
+    """Merge separate words into sentences; `boxes` is merged in place and its kept rows returned"""
+    return boxes.take(_sentence_rows(boxes, justify_ratio, gap_ratio))
+
+
+def merge_intersected_boxes(boxes: TextBoxes, bias: float = 2) -> TextBoxes:
+    """Merge intersected boxes (sentences or words); `boxes` is merged in place and its kept rows returned"""
+    return boxes.take(_intersected_rows(boxes, bias))
+
+
+def text_sentences_recognition(texts: List[Text], justify_ratio: float = 0.2, gap_ratio: float = 2) -> List[Text]:
+    """Merge separate words into a sentence"""
+    boxes = TextBoxes.from_texts(texts)
+    return [boxes.text(row, id=i) for i, row in enumerate(_sentence_rows(boxes, justify_ratio, gap_ratio))]
+
+
+def merge_intersected_texts(texts: List[Text], bias: float = 2) -> List[Text]:
+    """Merge intersected texts (sentences or words)"""
+    boxes = TextBoxes.from_texts(texts)
+    return [boxes.text(row, id=texts[row].id) for row in _intersected_rows(boxes, bias)]
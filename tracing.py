@@ -0,0 +1,194 @@
+"""
+Structured tracing of pipeline stages.
+
+A span covers one timed piece of work (a stage, an LLM request, OCR of an image) with `time.perf_counter_ns`
+timestamps, its parent span and free-form tags (report id, model, tokens, cache hits). Spans nest through a
+ContextVar, so a stage run in the stage pool still belongs to the report that submitted it, and they inherit
+the report id of their parent. Every finished span feeds a per-name histogram with p50/p95/p99; finished spans
+are also kept (up to `max_spans`) for export as JSON lines or in the Chrome trace format (chrome://tracing,
+Perfetto). Tracing is off until `tracer.enable()`: `span()` then returns a shared no-op object, so disabled
+instrumentation costs one attribute check.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class Histogram:
+    """Durations in logarithmic buckets (about 2% wide) from 1 microsecond up; memory does not grow with samples"""
+
+    GROWTH = 1.02
+    MIN_NS = 1000
+
+    def __init__(self, buckets: int = 1200):
+        self.counts = np.zeros(buckets, dtype=np.int64)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns: int):
+        bucket = 0 if duration_ns <= self.MIN_NS else int(math.log(duration_ns / self.MIN_NS, self.GROWTH)) + 1
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        self.max_ns = max(self.max_ns, duration_ns)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile, in nanoseconds"""
+        if not self.count:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), math.ceil(q / 100 * self.count)))
+        return min(self.MIN_NS * self.GROWTH ** bucket, self.max_ns)
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "thread", "tags", "_token")
+
+    def __init__(self, name: str, parent: Optional["Span"], tags: Dict[str, Any]):
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        if parent is not None and "report" in parent.tags:
+            tags.setdefault("report", parent.tags["report"])
+        self.tags = tags
+        self.thread = threading.get_ident()
+        self.start_ns = self.end_ns = 0
+        self._token = None
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    @property
+    def duration_ns(self) -> int:
+        return self.end_ns - self.start_ns
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.perf_counter_ns()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.tags["error"] = exc_type.__name__
+        tracer.finish(self)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "id": self.span_id, "parent": self.parent_id, "thread": self.thread,
+                "start_ns": self.start_ns, "duration_ns": self.duration_ns, "tags": self.tags}
+
+
+class _NoopSpan:
+    """Stands in for a span while tracing is disabled"""
+
+    def tag(self, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NOOP = _NoopSpan()
+_span_ids = iter(range(1, 2 ** 63))  # next() on a range iterator is atomic under the GIL
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.max_spans = 1_000_000
+        self.lock = threading.Lock()
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.histograms: Dict[str, Histogram] = {}
+
+    def enable(self, max_spans: int = 1_000_000):
+        """Start tracing; at most `max_spans` spans are kept for export (histograms count every span)"""
+        self.max_spans = max_spans
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.spans, self.dropped, self.histograms = [], 0, {}
+
+    def finish(self, span: Span):
+        with self.lock:
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = Histogram()
+            histogram.add(span.duration_ns)
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per span name: count, mean, total and p50/p95/p99/max durations, in milliseconds"""
+        with self.lock:
+            return {name: {"count": h.count, "total_ms": h.total_ns / 1e6, "mean_ms": h.total_ns / h.count / 1e6,
+                           "p50_ms": h.percentile(50) / 1e6, "p95_ms": h.percentile(95) / 1e6,
+                           "p99_ms": h.percentile(99) / 1e6, "max_ms": h.max_ns / 1e6}
+                    for name, h in sorted(self.histograms.items())}
+
+    def format_stats(self) -> str:
+        lines = [f"{'span':<40} {'count':>7} {'mean':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'total':>11}"]
+        for name, s in self.stats().items():
+            lines.append(f"{name:<40} {s['count']:>7} {s['mean_ms']:>8.1f}ms {s['p50_ms']:>8.1f}ms "
+                         f"{s['p95_ms']:>8.1f}ms {s['p99_ms']:>8.1f}ms {s['total_ms'] / 1e3:>10.1f}s")
+        return "\n".join(lines)
+
+    def _snapshot(self) -> List[Span]:
+        with self.lock:
+            return list(self.spans)
+
+    def export_jsonl(self, path: str) -> int:
+        """One JSON object per span; returns the number of spans written"""
+        spans = self._snapshot()
+        with open(path, mode="w", encoding="utf-8") as f:
+            for s in spans:
+                f.write(json.dumps(s.as_dict(), ensure_ascii=False, default=str) + "\n")
+        return len(spans)
+
+    def export_chrome(self, path: str) -> int:
+        """Spans as complete ("X") events of the Chrome trace event format, one track per thread"""
+        spans = self._snapshot()
+        pid = os.getpid()
+        events = [{"name": s.name, "ph": "X", "pid": pid, "tid": s.thread, "ts": s.start_ns / 1e3,
+                   "dur": s.duration_ns / 1e3, "args": {"id": s.span_id, "parent": s.parent_id, **s.tags}}
+                  for s in spans]
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
+        return len(spans)
+
+
+tracer = Tracer()
+
+
+def span(name: str, **tags):
+    """Context manager timing a block as a child of the current span"""
+    if not tracer.enabled:
+        return _NOOP
+    return Span(name, _current_span.get(), tags)
+
+
+def annotate(**tags):
+    """Add tags to the current span, if tracing"""
+    if tracer.enabled:
+        current = _current_span.get()
+        if current is not None:
+            current.tags.update(tags)
+
@@ -1,29 +1,30 @@
+import copy
 import functools
-import json
+import logging
+import os
+import threading
 import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
-import requests
 
-from logger import logger
+from logger import capture_records, logger, replay_records
+from tracing import span, tracer
 
 dataset_base = Path(__file__).parent.resolve() / "dataset"
 
 def load_reports():
-    dataset_file = str(dataset_base / "dataset.txt")
-    with open(dataset_file, mode="r", encoding="utf-8") as f:
-        dataset = json.load(f)
-    return dataset
+    """Every report of the dataset as a list of dicts; see `dataset.ReportDataset` for lazy and sharded access"""
+    from dataset import ReportDataset
+    return list(ReportDataset())
 
 def get_labels_true():
-    labels_true = {}
-    dataset_file = str(dataset_base / "dataset.txt")
-    with open(dataset_file, mode="r", encoding="utf-8") as f:
-        dataset = json.load(f)
-        for item in dataset:
-            labels_true[str(item["index"])] = item["consistent"]
-    return labels_true
+    from dataset import ReportDataset
+    return ReportDataset().labels_dict()
 
 def get_labels_pred(log_file: str):
     labels_pred = {}
@@ -36,37 +37,140 @@ def get_labels_pred(log_file: str):
                 labels_pred[index] = "y" if pred == "true" else "n"
         return labels_pred
 
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB (peak RSS where the current one is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 def timeit(func):
+    """Time every call: as a span named after the function when tracing, else as a log line"""
     @functools.wraps(func)
     def sync_wrapper(*args, **kwargs):
-        start_time = time.time()
+        if tracer.enabled:
+            with span(func.__name__):
+                return func(*args, **kwargs)
+        start_time = time.perf_counter()
         result = func(*args, **kwargs)  # 执行普通函数
-        end_time = time.time()
-        logger.info(f"Function {func.__name__} executed in {end_time - start_time:.4f}s")
+        logger.info(f"Function {func.__name__} executed in {time.perf_counter() - start_time:.4f}s",
+                    extra={"stage": func.__name__})
         return result
     return sync_wrapper
 
+_stage_outcomes: ContextVar[Optional[List[Tuple[str, Any]]]] = ContextVar("stage_outcomes", default=None)
+
+def record_stage(func):
+    """Record (stage name, return value) into the enclosing `collect_stage_outcomes()`"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        outcomes = _stage_outcomes.get()
+        if outcomes is not None:
+            outcomes.append((func.__name__, result))
+        return result
+    return wrapper
+
+@contextmanager
+def collect_stage_outcomes():
+    outcomes = []
+    token = _stage_outcomes.set(outcomes)
+    try:
+        yield outcomes
+    finally:
+        _stage_outcomes.reset(token)
+
+def replay_stage_outcomes(outcomes: List[Tuple[str, Any]]):
+    """Append outcomes collected elsewhere (e.g. in a speculative stage) to the current collection"""
+    current = _stage_outcomes.get()
+    if current is not None:
+        current.extend(outcomes)
+
+class _StageMemo:
+    """Stage results of one `shared_stages()` block, shared by the threads of its stage pool"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[tuple, Future] = {}
+
+_stage_memo: ContextVar[Optional[_StageMemo]] = ContextVar("stage_memo", default=None)
+
+def _shared_copy(record: logging.LogRecord) -> logging.LogRecord:
+    # a cached stage costs nothing again: "[shared]" lines count for the chain, not for the spend
+    record = copy.copy(record)
+    record.msg, record.args = f"[shared] {record.getMessage()}", None
+    return record
+
+def share_stage(func):
+    """
+    Within `shared_stages()`, compute a stage at most once for identical inputs. Its log lines are kept with
+    its value and replayed, marked "[shared]", to every later caller; a caller arriving while the stage is
+    still running (e.g. in a speculative thread) waits for it instead of running it again. Failures are not
+    shared: callers that waited for a failed run run the stage again.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        memo = _stage_memo.get()
+        if memo is None:
+            return func(*args, **kwargs)
+        key = (func.__qualname__, repr(args), repr(sorted(kwargs.items())))
+        while True:
+            with memo.lock:
+                entry = memo.entries.get(key)
+                owner = entry is None
+                if owner:
+                    entry = memo.entries[key] = Future()
+            if owner:
+                break
+            if entry.exception() is not None:
+                # failures are not shared: the owner evicted the entry, so run the stage again
+                continue
+            value, records = entry.result()
+            replay_records([_shared_copy(r) for r in records])
+            return value
+        error = None
+        with capture_records() as records:
+            try:
+                value = func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+        replay_records(records)
+        if error is not None:
+            with memo.lock:
+                del memo.entries[key]
+            # wakes the callers waiting for this run, which then run the stage themselves
+            entry.set_exception(error)
+            raise error
+        entry.set_result((value, records))
+        return value
+    return wrapper
+
+@contextmanager
+def shared_stages():
+    token = _stage_memo.set(_StageMemo())
+    try:
+        yield
+    finally:
+        _stage_memo.reset(token)
+
 def download_img_from_url(url: str, idx: int):
-    dataset_image_folder = dataset_base / "images"
-    if not dataset_image_folder.exists():
-        dataset_image_folder.mkdir()
-    target_file = dataset_image_folder / f"{idx}.jpg"
-    if target_file.exists():
-        print(f"Image {target_file} already exists")
-        return
+    """Download one screenshot; see `downloader.download_dataset` for the whole dataset"""
+    from downloader import Downloader
+    downloader = Downloader(str(dataset_base / "images"), workers=1)
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(f"{str(dataset_image_folder)}/{idx}.jpg", "wb") as f:
-                f.write(response.content)
-            print(f"img downloaded: {str(dataset_image_folder)}/{idx}.jpg")
-        else:
-            print(f"{idx} download failed: response code {response.status_code}")
-    except Exception as e:
-        print(f"{idx} download failed: {e}")
+        # an image already on disk is kept (and adopted into the manifest), as before there was a manifest
+        if not downloader.is_complete(f"{idx}.jpg", url):
+            downloader.fetch(url, f"{idx}.jpg")
+        downloader.save_manifest()
+    finally:
+        downloader.close()
 
 
 class Text:
+    __slots__ = ("id", "content", "location", "width", "height", "area", "word_width")
+
     def __init__(self, id, content, location):
         self.id = id
         self.content = content
@@ -169,63 +273,165 @@ class Text:
         self.word_width = self.width / len(self.content)
 
     def shrink_bound(self, binary_map):
+        """Move each bound inwards past the empty lines of the binary map at the box edge"""
         bin_clip = binary_map[self.location['top']:self.location['bottom'], self.location['left']:self.location['right']]
-        height, width = np.shape(bin_clip)
-
-        shrink_top = 0
-        shrink_bottom = 0
-        for i in range(height):
-            # top
-            if shrink_top == 0:
-                if sum(bin_clip[i]) == 0:
-                    shrink_top = 1
-                else:
-                    shrink_top = -1
-            elif shrink_top == 1:
-                if sum(bin_clip[i]) != 0:
-                    self.location['top'] += i
-                    shrink_top = -1
-            # bottom
-            if shrink_bottom == 0:
-                if sum(bin_clip[height-i-1]) == 0:
-                    shrink_bottom = 1
-                else:
-                    shrink_bottom = -1
-            elif shrink_bottom == 1:
-                if sum(bin_clip[height-i-1]) != 0:
-                    self.location['bottom'] -= i
-                    shrink_bottom = -1
-
-            if shrink_top == -1 and shrink_bottom == -1:
-                break
-
-        shrink_left = 0
-        shrink_right = 0
-        for j in range(width):
-            # left
-            if shrink_left == 0:
-                if sum(bin_clip[:, j]) == 0:
-                    shrink_left = 1
-                else:
-                    shrink_left = -1
-            elif shrink_left == 1:
-                if sum(bin_clip[:, j]) != 0:
-                    self.location['left'] += j
-                    shrink_left = -1
-            # right
-            if shrink_right == 0:
-                if sum(bin_clip[:, width-j-1]) == 0:
-                    shrink_right = 1
-                else:
-                    shrink_right = -1
-            elif shrink_right == 1:
-                if sum(bin_clip[:, width-j-1]) != 0:
-                    self.location['right'] -= j
-                    shrink_right = -1
-
-            if shrink_left == -1 and shrink_right == -1:
-                break
+        top, bottom = _edge_gaps(np.any(bin_clip, axis=1))
+        left, right = _edge_gaps(np.any(bin_clip, axis=0))
+        self.location['top'] += top
+        self.location['bottom'] -= bottom
+        self.location['left'] += left
+        self.location['right'] -= right
         self.width = self.location['right'] - self.location['left']
         self.height = self.location['bottom'] - self.location['top']
         self.area = self.width * self.height
         self.word_width = self.width / len(self.content)
+
+
+def _edge_gaps(filled: np.ndarray) -> Tuple[int, int]:
+    """Number of empty lines before the first and after the last filled line (0, 0 if no line is filled)"""
+    lines = np.flatnonzero(filled)
+    if not len(lines):
+        return 0, 0
+    return int(lines[0]), int(len(filled) - 1 - lines[-1])
+
+
+class TextBoxes:
+    """
+    The text boxes of one screenshot as a struct of arrays: row i is the box `bounds[i]`
+    (left, top, right, bottom) holding `contents[i]`. Geometry is computed for all rows, or for all
+    pairs of two row selections, at once; `text(i)` gives a `Text` of one row.
+    """
+    __slots__ = ("bounds", "contents", "lengths")
+
+    def __init__(self, bounds, contents: List[str]):
+        self.bounds = np.asarray(bounds).reshape(-1, 4)
+        if not np.issubdtype(self.bounds.dtype, np.integer):
+            self.bounds = self.bounds.astype(np.float64)
+        self.contents = list(contents)
+        self.lengths = np.fromiter(map(len, self.contents), dtype=np.int64, count=len(self.contents))
+
+    @staticmethod
+    def from_texts(texts: List["Text"]) -> "TextBoxes":
+        bounds = [[t.location['left'], t.location['top'], t.location['right'], t.location['bottom']] for t in texts]
+        return TextBoxes(np.array(bounds) if texts else np.empty((0, 4), dtype=np.int64), [t.content for t in texts])
+
+    @staticmethod
+    def from_paddle(paddle_result) -> "TextBoxes":
+        """Boxes of a Paddle result [[box points, (text, score)], ...], truncated to integer pixels"""
+        if not paddle_result:
+            return TextBoxes(np.empty((0, 4), dtype=np.int64), [])
+        points = np.array([line[0] for line in paddle_result], dtype=np.float64)
+        bounds = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+        return TextBoxes(np.trunc(bounds).astype(np.int64), [line[1][0] for line in paddle_result])
+
+    def __len__(self):
+        return len(self.contents)
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.bounds[:, 2] - self.bounds[:, 0]
+
+    @property
+    def height(self) -> np.ndarray:
+        return self.bounds[:, 3] - self.bounds[:, 1]
+
+    @property
+    def area(self) -> np.ndarray:
+        return self.width * self.height
+
+    @property
+    def word_width(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.width / self.lengths
+
+    def box(self, i: int) -> Tuple:
+        return tuple(self.bounds[i].tolist())
+
+    def text(self, i: int, id: Optional[int] = None) -> "Text":
+        left, top, right, bottom = self.box(i)
+        return Text(i if id is None else id, self.contents[i],
+                    {'left': left, 'top': top, 'right': right, 'bottom': bottom})
+
+    def texts(self) -> List["Text"]:
+        return [self.text(i) for i in range(len(self))]
+
+    def take(self, rows) -> "TextBoxes":
+        rows = np.asarray(rows, dtype=np.int64)
+        return TextBoxes(self.bounds[rows], [self.contents[i] for i in rows])
+
+    def merge(self, dst: int, src: int):
+        """Grow row `dst` to also cover row `src`, like `Text.merge_text`"""
+        self.bounds[dst, :2] = np.minimum(self.bounds[dst, :2], self.bounds[src, :2])
+        self.bounds[dst, 2:] = np.maximum(self.bounds[dst, 2:], self.bounds[src, 2:])
+        # Text.merge_text orders the contents by left edge after growing, so the grown box always comes first
+        self.contents[dst] = self.contents[dst] + ' ' + self.contents[src]
+        self.lengths[dst] = len(self.contents[dst])
+
+    def _pairs(self, a, b) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Bounds and content lengths of rows a and b, broadcasting to all pairs: a single row a is compared
+        with each row of b, row selections give an (a, b) matrix.
+        """
+        a = np.arange(len(self)) if a is None else a
+        b = np.arange(len(self)) if b is None else b
+        if np.ndim(a) == 0:
+            return self.bounds[a], self.bounds[b], self.lengths[a], self.lengths[b]
+        a, b = np.asarray(a), np.atleast_1d(b)
+        return self.bounds[a][:, None, :], self.bounds[b][None, :, :], self.lengths[a][:, None], self.lengths[b][None, :]
+
+    @staticmethod
+    def _justified(box_a: np.ndarray, box_b: np.ndarray, bias) -> np.ndarray:
+        return (np.abs(box_a[..., 1] - box_b[..., 1]) < bias) & (np.abs(box_a[..., 3] - box_b[..., 3]) < bias)
+
+    @staticmethod
+    def _gap(box_a: np.ndarray, box_b: np.ndarray, bias) -> np.ndarray:
+        return (np.abs(box_a[..., 2] - box_b[..., 0]) < bias) | (np.abs(box_a[..., 0] - box_b[..., 2]) < bias)
+
+    def on_same_line(self, a: int, b: int, justify_ratio: float, gap_ratio: float) -> bool:
+        """`same_line_mask` of a single pair, without the array overhead"""
+        left_a, top_a, right_a, bottom_a = self.box(a)
+        left_b, top_b, right_b, bottom_b = self.box(b)
+        bias_justify = justify_ratio * min(bottom_a - top_a, bottom_b - top_b)
+        bias_gap = gap_ratio * max((right_a - left_a) / len(self.contents[a]), (right_b - left_b) / len(self.contents[b]))
+        return (abs(top_a - top_b) < bias_justify and abs(bottom_a - bottom_b) < bias_justify
+                and (abs(right_a - left_b) < bias_gap or abs(left_a - right_b) < bias_gap))
+
+    def intersects(self, a: int, b: int, bias) -> bool:
+        """`intersection_mask` of a single pair, without the array overhead"""
+        left_a, top_a, right_a, bottom_a = self.box(a)
+        left_b, top_b, right_b, bottom_b = self.box(b)
+        return (min(right_a, right_b) - (max(left_a, left_b) + bias) > 0
+                and min(bottom_a, bottom_b) - (max(top_a, top_b) + bias) > 0)
+
+    def justified_mask(self, bias, a=None, b=None) -> np.ndarray:
+        """Pairs (a, b) whose top and bottom edges are both less than `bias` apart, see `Text.is_justified`"""
+        box_a, box_b, _, _ = self._pairs(a, b)
+        return self._justified(box_a, box_b, bias)
+
+    def gap_mask(self, bias, a=None, b=None) -> np.ndarray:
+        """Pairs (a, b) horizontally less than `bias` apart, edge to edge"""
+        box_a, box_b, _, _ = self._pairs(a, b)
+        return self._gap(box_a, box_b, bias)
+
+    def same_line_mask(self, justify_ratio: float, gap_ratio: float, a=None, b=None) -> np.ndarray:
+        """Pairs (a, b) on the same row, see `Text.is_on_same_line` with biases relative to the box sizes"""
+        box_a, box_b, len_a, len_b = self._pairs(a, b)
+        bias_justify = justify_ratio * np.minimum(box_a[..., 3] - box_a[..., 1], box_b[..., 3] - box_b[..., 1])
+        bias_gap = gap_ratio * np.maximum((box_a[..., 2] - box_a[..., 0]) / len_a,
+                                          (box_b[..., 2] - box_b[..., 0]) / len_b)
+        return self._justified(box_a, box_b, bias_justify) & self._gap(box_a, box_b, bias_gap)
+
+    def intersection_mask(self, bias, a=None, b=None) -> np.ndarray:
+        """Pairs (a, b) overlapping by more than `bias` in both directions, see `Text.is_intersected`"""
+        box_a, box_b, _, _ = self._pairs(a, b)
+        lo = np.maximum(box_a[..., :2], box_b[..., :2]) + bias
+        hi = np.minimum(box_a[..., 2:], box_b[..., 2:])
+        return np.all(hi - lo > 0, axis=-1)
+
+    def shrink(self, binary_map):
+        """`Text.shrink_bound` of every box"""
+        for i, (left, top, right, bottom) in enumerate(self.bounds.tolist()):
+            clip = binary_map[top:bottom, left:right]
+            shrink_top, shrink_bottom = _edge_gaps(np.any(clip, axis=1))
+            shrink_left, shrink_right = _edge_gaps(np.any(clip, axis=0))
+            self.bounds[i] = (left + shrink_left, top + shrink_top, right - shrink_right, bottom - shrink_bottom)